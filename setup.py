@@ -16,7 +16,7 @@ setuptools.setup(
     description='Amazon EC2 extension for clusto',
     install_requires=[
         'clusto>0.6',
-        'boto>=2.0',
+        'boto>=2.19.0',
         'mako',
     ],
     entry_points={
@@ -30,4 +30,7 @@ setuptools.setup(
     package_dir={
         '': 'src',
     },
+    package_data={
+        'clustoec2': ['instance_types.json'],
+    },
 )
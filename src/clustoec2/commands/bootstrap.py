@@ -4,6 +4,8 @@
 # vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
 #
 
+import hashlib
+import json
 import os
 import sys
 
@@ -11,6 +13,15 @@ import clusto
 from clusto import script_helper
 from clusto import drivers
 from clustoec2 import drivers as ec2_drivers
+from clustoec2 import stats
+
+
+def _fingerprint(*fields):
+    """
+    Returns a digest of the given (JSON serializable) fields
+    """
+
+    return hashlib.sha1(json.dumps(fields, sort_keys=True)).hexdigest()
 
 
 class BootstrapEc2(script_helper.Script):
@@ -49,6 +60,42 @@ class BootstrapEc2(script_helper.Script):
             '--no-import', default=False, action='store_true',
             help='Skip importing existing resources'
         )
+        parser.add_argument(
+            '--workers', '-w', default=1, type=int,
+            help='Number of regions to query AWS for in parallel. Writes '
+            'to clusto still happen one region at a time'
+        )
+        parser.add_argument(
+            '--incremental', '-i', default=False, action='store_true',
+            help='Only write to clusto what changed in AWS since the last '
+            'incremental run (as recorded in --state-file), objects gone from '
+            'AWS are deleted from clusto'
+        )
+        parser.add_argument(
+            '--state-file', default=os.path.expanduser('~/.clusto-ec2-bootstrap.json'),
+            help='Where incremental runs record what was imported, remove it '
+            'to force a full import (defaults to ~/.clusto-ec2-bootstrap.json)'
+        )
+        parser.add_argument(
+            '--batch-size', '-b', default=500, type=int,
+            help='Number of instances written to clusto per transaction '
+            '(defaults to 500)'
+        )
+        parser.add_argument(
+            '--checkpoint', default=os.path.expanduser('~/.clusto-ec2-bootstrap.checkpoint'),
+            help='Where the AWS scan and the import progress are saved while '
+            'importing (defaults to ~/.clusto-ec2-bootstrap.checkpoint)'
+        )
+        parser.add_argument(
+            '--resume', '-r', default=False, action='store_true',
+            help='Continue an interrupted import from its last committed batch, '
+            'using the AWS scan saved in --checkpoint'
+        )
+        parser.add_argument(
+            '--stats', nargs='?', const='summary', choices=('summary', 'json'),
+            help='Print AWS request and database timings and throttling (to stderr) when done, '
+            'as a summary table (the default) or as JSON'
+        )
 
     def add_subparser(self, subparsers):
         parser = self._setup_subparser(subparsers)
@@ -94,198 +141,583 @@ class BootstrapEc2(script_helper.Script):
                 )
             )
 
+        self._entities = {}
+        self._referencers = {}
+        self._contents = {}
+        self._state = None
+        if args.incremental:
+            self._state = self._load_json(args.state_file).get('objects', {})
+
         container_pool = None
         if args.add_to_pool:
             container_pool = clusto.get_or_create(
                 args.add_to_pool, drivers.pool.Pool)
-        self.info('Creating all available regions')
-        for region in ec2connman._connection().get_all_regions():
-            curconn = ec2connman._connection(region.name)
-            vpcconn = vpcman._connection(region.name)
-            region_entity = clusto.get_or_create(
-                region.name,
+
+        checkpoint = {}
+        progress = {}
+        progress_file = '%s.progress' % (args.checkpoint,)
+        if args.resume:
+            checkpoint = self._load_json(args.checkpoint)
+            if not checkpoint:
+                self.warn('Nothing to resume from %s' % (args.checkpoint,))
+        if checkpoint:
+            self.info('Resuming the import saved in %s' % (args.checkpoint,))
+            progress = self._load_json(progress_file).get('regions', {})
+            # The scan to resume from dictates what gets imported
+            args.no_import = checkpoint['no_import']
+        else:
+            checkpoint = {
+                'regions': self._discover(ec2connman, vpcman, args),
+                'no_import': args.no_import,
+            }
+            if os.path.isfile(progress_file):
+                os.unlink(progress_file)
+            self._save_json(args.checkpoint, checkpoint)
+
+        # Clusto writes happen serially and in region order
+        for data in checkpoint['regions']:
+            self._import_region(
+                data, ec2connman, vpcman, container_pool, progress, args
+            )
+        for filename in (args.checkpoint, progress_file):
+            if os.path.isfile(filename):
+                os.unlink(filename)
+        self.info('Finished, AWS objects should now be in the database')
+
+    def _discover(self, ec2connman, vpcman, args):
+        """
+        Queries AWS for all regions, up to args.workers at a time, and
+        returns the discovered data in region order
+        """
+
+        regions = [_.name for _ in ec2connman._connection().get_all_regions()]
+        self.info(
+            'Querying AWS for %d regions (%d at a time)' % (
+                len(regions), args.workers,
+            )
+        )
+        discovered = ec2connman._map_regions(
+            lambda region: self._discover_region(
+                region, ec2connman, vpcman, args.no_import
+            ),
+            regions, args.workers
+        )
+        failed = [(region, error) for region, data, error in discovered if error]
+        if failed:
+            raise Exception(
+                'Could not query AWS for %s, aborting the import' % (
+                    ', '.join(['%s (%s)' % _ for _ in failed]),
+                )
+            )
+        return [data for region, data, error in discovered]
+
+    def _discover_region(self, region, ec2connman, vpcman, no_import=False):
+        """
+        Grabs from AWS everything that is to be imported for a region. It
+        only reads from AWS and never touches clusto, so it can run for
+        several regions at the same time. The result only holds plain
+        (JSON serializable) records so it can be checkpointed
+        """
+
+        self.debug('Querying AWS for region %s' % (region, ))
+        curconn = ec2connman._connection(region)
+        vpcconn = vpcman._connection(region)
+        data = {
+            'region': region,
+            'vpcs': [],
+            'subnets': {},
+            'zones': [_.name for _ in curconn.get_all_zones()],
+            'zone_subnets': {},
+            'security_groups': [],
+            'instances': [],
+        }
+        for v in vpcconn.get_all_vpcs():
+            data['vpcs'].append({
+                'id': v.id,
+                'attrs': vpcman._vpc_to_dict(v),
+            })
+        # One call for all subnets, indexed by VPC and by availability zone
+        for sn in vpcconn.get_all_subnets():
+            data['subnets'].setdefault(sn.vpc_id, []).append({
+                'id': sn.id,
+                'vpc_id': sn.vpc_id,
+                'availability_zone': sn.availability_zone,
+                'attrs': vpcman._subnet_to_dict(sn),
+            })
+            data['zone_subnets'].setdefault(sn.availability_zone, []).append(sn.id)
+        for sg in vpcconn.get_all_security_groups():
+            data['security_groups'].append({
+                'id': sg.id,
+                'name': sg.name,
+                'vpc_id': sg.vpc_id,
+            })
+        if not no_import:
+            for reservations in vpcconn.get_all_instances():
+                for instance in reservations.instances:
+                    vpc = bool(instance.vpc_id and instance.subnet_id)
+                    connman = vpc and vpcman or ec2connman
+                    data['instances'].append({
+                        'id': instance.id,
+                        'name': instance.tags.get('Name', instance.id).lower().replace(' ', '_'),
+                        'vpc': vpc,
+                        'placement': instance.subnet_id or instance.placement,
+                        'instance_type': instance.instance_type,
+                        'key_name': instance.key_name,
+                        # Security group membership comes along with each
+                        # instance, so there's no need to ask every group
+                        # for its instances
+                        'groups': sorted(set([_.id for _ in instance.groups])),
+                        'private_ip_address': instance.private_ip_address,
+                        'ip_address': instance.ip_address,
+                        'attrs': connman._instance_to_dict(instance),
+                    })
+        self.debug('Done querying AWS for region %s' % (region, ))
+        return data
+
+    def _get_entity(self, name):
+        """
+        Returns the clusto entity with the given name, it is looked up only
+        once per run
+        """
+
+        if name not in self._entities:
+            self._entities[name] = clusto.get_by_name(name)
+        return self._entities[name]
+
+    def _get_or_create(self, name, driver, **kwargs):
+        """
+        Same as clusto.get_or_create but remembers the entity for the rest
+        of the run
+        """
+
+        if name not in self._entities:
+            self._entities[name] = clusto.get_or_create(name, driver, **kwargs)
+        return self._entities[name]
+
+    def _allocated(self, manager, entity):
+        """
+        Tells whether the entity is allocated from the manager. The
+        manager's referencers are only queried once per run
+        """
+
+        if manager.name not in self._referencers:
+            self._referencers[manager.name] = set(
+                [_.name for _ in manager.referencers()]
+            )
+        return entity.name in self._referencers[manager.name]
+
+    def _allocate(self, manager, entity):
+        manager.allocate(entity)
+        self._referencers[manager.name].add(entity.name)
+
+    def _contains(self, parent, entity):
+        """
+        Tells whether the entity is inside parent. The contents of parent
+        are only queried once per run
+        """
+
+        if parent.name not in self._contents:
+            self._contents[parent.name] = set(
+                [_.name for _ in parent.contents()]
+            )
+        return entity.name in self._contents[parent.name]
+
+    def _insert(self, parent, entity):
+        parent.insert(entity)
+        self._contents[parent.name].add(entity.name)
+
+    def _fingerprints(self, data, args):
+        """
+        Returns a dictionary with one "region/kind/id" key per discovered
+        object and a [fingerprint, entity name] value. The fingerprint only
+        covers what bootstrap writes to clusto for that object
+        """
+
+        region_name = data['region']
+        objects = {}
+
+        def add(kind, id, name, *fields):
+            objects['%s/%s/%s' % (region_name, kind, id)] = [
+                _fingerprint(kind, *fields), name
+            ]
+
+        add('region', region_name, region_name, region_name, args.add_to_pool)
+        for v in data['vpcs']:
+            add('vpc', v['id'], v['id'], v['id'])
+        for subnets in data['subnets'].values():
+            for sn in subnets:
+                add(
+                    'subnet', sn['id'], sn['id'], sn['id'], sn['vpc_id'],
+                    sn['availability_zone']
+                )
+        for zone in data['zones']:
+            add('zone', zone, zone, zone)
+        for sg in data['security_groups']:
+            add('security_group', sg['id'], sg['id'], sg['id'], sg['name'], sg['vpc_id'])
+        for instance in data['instances']:
+            add(
+                'instance', instance['id'], instance['name'], instance['name'],
+                instance['id'], instance['vpc'], instance['placement'],
+                instance['instance_type'], instance['key_name'],
+                instance['groups']
+            )
+        return objects
+
+    def _load_json(self, filename):
+        """
+        Returns the contents of a state/checkpoint file, or an empty dict
+        if there's none or it belongs to another database (files only keep
+        a digest of the DSN, as it may include the database password)
+        """
+
+        if not os.path.isfile(filename):
+            return {}
+        f = open(filename, 'rb')
+        data = json.load(f)
+        f.close()
+        if data.pop('dsn', None) != _fingerprint(self.config.get('clusto', 'dsn')):
+            self.warn(
+                '%s was written for another database, ignoring it' % (
+                    filename,
+                )
+            )
+            return {}
+        return data
+
+    def _save_json(self, filename, data):
+        """
+        Writes a state/checkpoint file (atomically, so an interruption
+        doesn't leave a truncated one behind), only readable by its owner
+        """
+
+        data = dict(data, dsn=_fingerprint(self.config.get('clusto', 'dsn')))
+        tmp = '%s.tmp' % (filename,)
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        f = os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600), 'wb')
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(tmp, filename)
+
+    def _transaction(self, func, *args):
+        """
+        Runs func(*args) inside a single clusto transaction
+        """
+
+        clusto.begin_transaction()
+        try:
+            result = func(*args)
+            clusto.commit()
+        except:
+            clusto.rollback_transaction()
+            raise
+        return result
+
+    def _prune_region(self, region_name, objects, args):
+        """
+        Deletes from clusto the objects a previous incremental run imported
+        for this region and that AWS doesn't report anymore, or that AWS
+        reports under another name (the new one was imported already).
+        Objects are named after the Name tag, so an entity is kept as long
+        as another discovered object (i.e. an instance with the same name)
+        maps to it
+        """
+
+        order = ('instance', 'security_group', 'subnet', 'vpc', 'zone', 'region')
+        stale = []
+        for key, (_, name) in self._state.items():
+            region, kind, id = key.split('/', 2)
+            if region != region_name:
+                continue
+            if kind == 'instance' and args.no_import:
+                continue
+            if key not in objects or objects[key][1] != name:
+                stale.append((order.index(kind), key, name))
+        stale_keys = set([_[1] for _ in stale])
+        in_use = set([_[1] for _ in objects.values()])
+        in_use.update([
+            v[1] for k, v in self._state.items()
+            if k not in objects and k not in stale_keys
+        ])
+        for _, key, name in sorted(stale):
+            if key in objects:
+                reason = '%s was renamed to %s' % (key, objects[key][1],)
+            else:
+                reason = '%s is gone from AWS' % (key,)
+                self._state.pop(key)
+            if name in in_use:
+                self.info('%s, but %s is still in use' % (reason, name,))
+                continue
+            self.info('%s, deleting %s' % (reason, name,))
+            try:
+                entity = clusto.get_by_name(name)
+            except LookupError:
+                continue
+            self._entities.pop(name, None)
+            self._contents.pop(name, None)
+            for names in self._referencers.values() + self._contents.values():
+                names.discard(name)
+            entity.entity.delete()
+
+    def _import_region(self, data, ec2connman, vpcman, container_pool, progress, args):
+        """
+        Writes everything discovered for a region into clusto: one
+        transaction for the locations and security groups, then one per
+        batch of instances. Progress is checkpointed after every commit.
+        In incremental mode objects whose fingerprint didn't change since
+        the last run are skipped altogether
+        """
+
+        region_name = data['region']
+        done = progress.get(region_name)
+        if done and done['finished']:
+            self.debug('Region %s was already imported' % (region_name,))
+            return
+
+        objects = self._fingerprints(data, args)
+        if self._state is None:
+            todo = set(objects.keys())
+        else:
+            todo = set([k for k, v in objects.items() if self._state.get(k) != v])
+            self.info(
+                '%d out of %d objects changed in region %s' % (
+                    len(todo), len(objects), region_name,
+                )
+            )
+
+        def changed(kind, id):
+            return '%s/%s/%s' % (region_name, kind, id) in todo
+
+        def checkpoint(instances, finished=False):
+            progress[region_name] = {
+                'instances': instances,
+                'finished': finished,
+            }
+            self._save_json(
+                '%s.progress' % (args.checkpoint,), {'regions': progress}
+            )
+
+        if not done:
+            self._transaction(
+                self._import_locations, data, changed, vpcman, container_pool, args
+            )
+            done = {'instances': 0}
+            checkpoint(0)
+        elif done['instances']:
+            self.info(
+                'Resuming region %s after %d instances' % (
+                    region_name, done['instances'],
+                )
+            )
+
+        if not args.no_import:
+            self.info('Creating all instances for region %s' % (region_name, ))
+        instances = data['instances']
+        for i in range(done['instances'], len(instances), args.batch_size):
+            batch = instances[i:i + args.batch_size]
+            self._transaction(
+                self._import_instances, batch, changed, ec2connman, vpcman
+            )
+            self.debug(
+                'Committed %d out of %d instances for region %s' % (
+                    i + len(batch), len(instances), region_name,
+                )
+            )
+            checkpoint(i + len(batch))
+
+        if self._state is not None:
+            self._transaction(self._prune_region, region_name, objects, args)
+            self._state.update(objects)
+            self._save_json(args.state_file, {'objects': self._state})
+        checkpoint(len(instances), finished=True)
+
+    def _import_locations(self, data, changed, vpcman, container_pool, args):
+        """
+        Writes the region, its VPCs, subnets, zones and security groups
+        """
+
+        region_name = data['region']
+        if changed('region', region_name):
+            region_entity = self._get_or_create(
+                region_name,
                 ec2_drivers.locations.datacenters.EC2Region,
-                region=region.name
+                region=region_name
             )
             region_entity.set_attr(
                 key='aws', subkey='ec2_region',
-                value=region.name
+                value=region_name
             )
-            self.debug('Created "%s" region' % (region.name, ))
-#           Create all VPCs (if any)
-            self.info(
-                'Creating all VPCs (if any) for region %s' % (
-                    region.name,
+            self.debug('Created "%s" region' % (region_name, ))
+            if container_pool and not self._contains(container_pool, region_entity):
+                self.debug(
+                    'Adding region %s to pool %s' % (
+                        region_name, args.add_to_pool,
+                    )
                 )
+                self._insert(container_pool, region_entity)
+#       Create all VPCs (if any)
+        self.info(
+            'Creating all VPCs (if any) for region %s' % (
+                region_name,
             )
-            for v in vpcconn.get_all_vpcs():
-                v_entity = clusto.get_or_create(
-                    v.id,
+        )
+        for v in data['vpcs']:
+            if changed('vpc', v['id']):
+                v_entity = self._get_or_create(
+                    v['id'],
                     ec2_drivers.locations.datacenters.VPC,
-                    vpc=v.id,
-                )
-                if v_entity not in vpcman.referencers():
-                    vpcman.allocate(v_entity)
-                    vpcman.additional_attrs(
-                        v_entity,
-                        resource={'vpc': v}
-                    )
-                self.debug('Created "%s" VPC' % (v.id, ))
-                if v_entity not in region_entity:
-                    region_entity.insert(v_entity)
-#               Create all subnets (if any)
-                self.info(
-                    'Creating all subnets (if any) for VPC %s' % (
-                        v.id,
-                    )
+                    vpc=v['id'],
                 )
-                for sn in vpcconn.get_all_subnets(filters={'vpc_id': v.id}):
-                    sn_entity = clusto.get_or_create(
-                        sn.id,
-                        ec2_drivers.locations.zones.VPCSubnet,
-                        subnet=sn.id,
-                    )
-                    if sn_entity not in vpcman.referencers():
-                        vpcman.allocate(sn_entity)
-                        vpcman.additional_attrs(
-                            sn_entity,
-                            resource={'subnet': sn}
-                        )
-                    if sn_entity not in v_entity:
-                        v_entity.insert(sn_entity)
-                        self.debug('Inserted subnet %s in VPC %s' % (
-                            sn.id, v.id, )
-                        )
-#           Create all zones
+                if not self._allocated(vpcman, v_entity):
+                    self._allocate(vpcman, v_entity)
+                    vpcman.add_resource_attrs(v_entity, 'vpc', v['attrs'])
+                self.debug('Created "%s" VPC' % (v['id'], ))
+                region_entity = self._get_entity(region_name)
+                if not self._contains(region_entity, v_entity):
+                    self._insert(region_entity, v_entity)
+#           Create all subnets (if any)
             self.info(
-                'Creating all availability zones for region %s' % (
-                    region.name,
+                'Creating all subnets (if any) for VPC %s' % (
+                    v['id'],
                 )
             )
-            for zone in curconn.get_all_zones():
-                zone_entity = clusto.get_or_create(
-                    zone.name,
+            for sn in data['subnets'].get(v['id'], []):
+                if not changed('subnet', sn['id']):
+                    continue
+                sn_entity = self._get_or_create(
+                    sn['id'],
+                    ec2_drivers.locations.zones.VPCSubnet,
+                    subnet=sn['id'],
+                )
+                if not self._allocated(vpcman, sn_entity):
+                    self._allocate(vpcman, sn_entity)
+                    vpcman.add_resource_attrs(sn_entity, 'subnet', sn['attrs'])
+                v_entity = self._get_entity(v['id'])
+                if not self._contains(v_entity, sn_entity):
+                    self._insert(v_entity, sn_entity)
+                    self.debug('Inserted subnet %s in VPC %s' % (
+                        sn['id'], v['id'], )
+                    )
+#       Create all zones
+        self.info(
+            'Creating all availability zones for region %s' % (
+                region_name,
+            )
+        )
+        for zone in data['zones']:
+            if changed('zone', zone):
+                zone_entity = self._get_or_create(
+                    zone,
                     ec2_drivers.locations.zones.EC2Zone,
-                    placement=zone.name
+                    placement=zone
                 )
                 zone_entity.set_attr(
                     key='aws', subkey='ec2_placement',
-                    value=zone.name
+                    value=zone
                 )
-                self.debug('Created "%s" zone' % (zone.name, ))
-                if zone_entity not in region_entity:
-                    region_entity.insert(zone_entity)
+                self.debug('Created "%s" zone' % (zone, ))
+                region_entity = self._get_entity(region_name)
+                if not self._contains(region_entity, zone_entity):
+                    self._insert(region_entity, zone_entity)
                 self.debug(
                     'Inserted "%s" zone in "%s" region' % (
-                        zone.name, region.name,
+                        zone, region_name,
                     )
                 )
-#               if there are subnets in this region, insert them
-                for sn in vpcconn.get_all_subnets(
-                    filters={
-                        'availability-zone': zone.name,
-                    }
-                ):
-                    sn_entity = clusto.get_by_name(sn.id)
-                    if sn_entity not in zone_entity:
-                        zone_entity.insert(sn_entity)
-                        self.debug('Inserted %s subnet in %s AZ' % (
-                            sn.id, zone.name, )
-                        )
-            if container_pool and region_entity not in container_pool:
-                self.debug(
-                    'Adding region %s to pool %s' % (
-                        region.name, args.add_to_pool,
+#           if there are subnets in this region, insert them
+            for sn in data['zone_subnets'].get(zone, []):
+                if not changed('subnet', sn):
+                    continue
+                sn_entity = self._get_entity(sn)
+                zone_entity = self._get_entity(zone)
+                if not self._contains(zone_entity, sn_entity):
+                    self._insert(zone_entity, sn_entity)
+                    self.debug('Inserted %s subnet in %s AZ' % (
+                        sn, zone, )
                     )
-                )
-                container_pool.insert(region_entity)
-
-        self.info('Creating all security groups')
-        sgs = vpcman._connection().get_all_security_groups()
-        belong = {}
-        for sg in sgs:
-            belong[sg.id] = [_.id for _ in sg.instances()]
-        sgs = [(_.id, _.name, _.region.name, _.vpc_id) for _ in sgs]
-        for sg_id, sg_name, region_name, vpc_id in sgs:
+
+        self.info('Creating all security groups for region %s' % (region_name, ))
+        for sg in data['security_groups']:
+            if not changed('security_group', sg['id']):
+                continue
+            sg_id, sg_name, vpc_id = sg['id'], sg['name'], sg['vpc_id']
             self.debug(
                 'Importing %s (%s), region: %s, vpc? %s' % (
                     sg_name, sg_id, region_name, bool(vpc_id),
                 )
             )
-            sg_ent = clusto.get_or_create(
+            sg_ent = self._get_or_create(
                 sg_id,
                 ec2_drivers.categories.securitygroup.EC2SecurityGroup,
                 group_id=sg_id,
                 group_name=sg_name
             )
-            if vpc_id:
-                parent = clusto.get_by_name(vpc_id)
-            else:
-                parent = clusto.get_by_name(region_name)
-            if sg_ent not in parent:
+            parent = self._get_entity(vpc_id or region_name)
+            if not self._contains(parent, sg_ent):
                 self.debug('Inserting security group %s into %s' % (sg_id, vpc_id or region_name,))
-                parent.insert(sg_ent)
+                self._insert(parent, sg_ent)
 
-        if not args.no_import:
-            self.info('Creating all instances')
-            for reservations in vpcman._connection().get_all_instances():
-                for instance in reservations.instances:
-                    idriver = ec2_drivers.devices.servers.EC2VirtualServer
-                    connman = ec2connman
-                    name = instance.tags.get('Name', instance.id).lower().replace(' ', '_')
-                    if instance.vpc_id and instance.subnet_id:
-                        idriver = ec2_drivers.devices.servers.VPCVirtualServer
-                        connman = vpcman
-                    self.debug('Creating %s instance (%s)' % (name, idriver, ))
-                    instance_entity = clusto.get_or_create(
-                        name,
-                        idriver,
-                    )
-                    placement = clusto.get_by_name(instance.subnet_id or instance.placement)
-                    self.debug('Inserting instance %s into %s' % (name, placement, ))
-                    if instance_entity not in placement:
-                        placement.insert(instance_entity)
-                    instance_entity.set_attr(
-                        key='aws', subkey='ec2_instance_type',
-                        value=instance.instance_type
-                    )
-                    if instance.key_name is not None:
-                        instance_entity.set_attr(
-                            key='aws', subkey='ec2_key_name',
-                            value=instance.key_name
+    def _import_instances(self, instances, changed, ec2connman, vpcman):
+        """
+        Writes a batch of instances
+        """
+
+        for instance in instances:
+            if not changed('instance', instance['id']):
+                continue
+            idriver = ec2_drivers.devices.servers.EC2VirtualServer
+            connman = ec2connman
+            name = instance['name']
+            if instance['vpc']:
+                idriver = ec2_drivers.devices.servers.VPCVirtualServer
+                connman = vpcman
+            self.debug('Creating %s instance (%s)' % (name, idriver, ))
+            instance_entity = self._get_or_create(
+                name,
+                idriver,
+            )
+            placement = self._get_entity(instance['placement'])
+            self.debug('Inserting instance %s into %s' % (name, placement, ))
+            if not self._contains(placement, instance_entity):
+                self._insert(placement, instance_entity)
+            instance_entity.set_attr(
+                key='aws', subkey='ec2_instance_type',
+                value=instance['instance_type']
+            )
+            if instance['key_name'] is not None:
+                instance_entity.set_attr(
+                    key='aws', subkey='ec2_key_name',
+                    value=instance['key_name']
+                )
+            instance_entity.set_attr(
+                key='aws',
+                subkey='ec2_instance_id',
+                value=instance['id'],
+            )
+
+            for sg in instance['groups']:
+                sg_ent = self._get_entity(sg)
+                if not self._contains(sg_ent, instance_entity):
+                    self.debug(
+                        'Adding instance %s to security group %s' % (
+                            instance['id'], sg,
                         )
-                    instance_entity.set_attr(
-                        key='aws',
-                        subkey='ec2_instance_id',
-                        value=instance.id,
                     )
+                    self._insert(sg_ent, instance_entity)
 
-                    for sg, instances in belong.items():
-                        if instance.id in instances:
-                            sg_ent = clusto.get_by_name(sg)
-                            if instance_entity not in sg_ent:
-                                self.debug(
-                                    'Adding instance %s to security group %s' % (
-                                        instance.id, sg,
-                                    )
-                                )
-                                sg_ent.insert(instance_entity)
-
-                    self.debug('Allocating instance %s from %s' % (name, connman, ))
-                    if instance_entity not in connman.referencers():
-                        connman.allocate(instance_entity)
-                        connman.additional_attrs(
-                            instance_entity,
-                            resource={'instance': instance}
-                        )
-                        instance_entity.update_metadata()
-                    self.debug('%s is imported' % (instance,))
-        self.info('Finished, AWS objects should now be in the database')
+            self.debug('Allocating instance %s from %s' % (name, connman, ))
+            if not self._allocated(connman, instance_entity):
+                self._allocate(connman, instance_entity)
+                connman.add_resource_attrs(instance_entity, 'instance', instance['attrs'])
+                instance_entity.set_ip_metadata(
+                    instance['private_ip_address'], instance['ip_address']
+                )
+            self.debug('%s is imported' % (instance['id'],))
 
 
 def main():
     bootstrap, args = script_helper.init_arguments(BootstrapEc2)
-    return(bootstrap.run(args))
+    return(stats.run_script(bootstrap, args))
 
 if __name__ == '__main__':
     sys.exit(main())
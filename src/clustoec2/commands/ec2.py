@@ -32,6 +32,8 @@ except ImportError:
 import clusto
 from clusto import script_helper
 from clustoec2 import drivers as ec2_drivers
+from clustoec2.drivers import base
+from clustoec2 import stats
 
 
 class Ec2(script_helper.Script):
@@ -67,6 +69,14 @@ class Ec2(script_helper.Script):
     def run(self, args):
         "Main run method"
 
+        kwargs = dict(args.__dict__.items())
+        for _ in ('command', 'config', 'dsn', 'loglevel', 'instances', 'stats',):
+            kwargs.pop(_)
+        # These are addresses or CIDR ranges, not clusto objects
+        if args.command == 'find-ip':
+            kwargs['addresses'] = args.instances
+            return self.run_find_ip(**kwargs)
+
         objects = []
         for _ in args.instances:
             try:
@@ -79,9 +89,6 @@ class Ec2(script_helper.Script):
             except Exception as e:
                 self.critical(e)
                 return
-        kwargs = dict(args.__dict__.items())
-        for _ in ('command', 'config', 'dsn', 'loglevel', 'instances',):
-            kwargs.pop(_)
         kwargs['objects'] = objects
         self.debug(kwargs)
         # Only the create command should (and in fact, *must*) receive an empty list of objects
@@ -98,10 +105,24 @@ class Ec2(script_helper.Script):
         data = connman._instance_to_dict(instance._instance)
         return data
 
+    def _fetch_instances(self, objects):
+        """
+        Fetches the AWS instances for all the given objects with one
+        (chunked) DescribeInstances call per connection manager and region.
+        Returns a dictionary of object name -> boto.ec2.Instance (or None
+        if not found)
+        """
+
+        return base.prefetch(
+            [_ for _ in objects if isinstance(_, ec2_drivers.servers.EC2VirtualServer)],
+            'instance'
+        )
+
     def run_show(self, **kwargs):
         "Prints the AWS data of the given objects to stdout"
 
         objs = []
+        self._fetch_instances(kwargs.get('objects'))
         for obj in kwargs.get('objects'):
             objs.append({obj.name: self._get_instance_data(obj)})
         self.debug(objs)
@@ -112,12 +133,31 @@ class Ec2(script_helper.Script):
         "Prints the AWS state of the given objects to stdout"
 
         objs = []
+        instances = self._fetch_instances(kwargs.get('objects'))
         for obj in kwargs.get('objects'):
-            objs.append({obj.name: obj.state})
+            if obj.name in instances:
+                # Already fresh from the batched call, no need to update()
+                instance = instances[obj.name]
+                objs.append({obj.name: instance.state if instance else None})
+            else:
+                objs.append({obj.name: obj.state})
         self.debug(objs)
         cb = self.formatters[kwargs.get('format', 'pprint')]
         print cb[0](objs, **cb[1])
 
+    def _wait_for_state(self, objs, state):
+        "Waits for all the given objects to be in the given state"
+
+        self.info('Wait until instance(s) is/are in %s state' % (state,))
+        states, timeouts = ec2_drivers.servers.wait_for_state(objs, state)
+        for name in timeouts:
+            self.warn(
+                '%s did not reach the %s state in time (last seen %s)' % (
+                    name, state, states.get(name),
+                )
+            )
+        return timeouts and 1 or None
+
     def _change_state(self, **kwargs):
         "Handles changing the state to running/stopped"
 
@@ -125,20 +165,21 @@ class Ec2(script_helper.Script):
         assert state in ('running', 'stopped',)
         wait = kwargs.get('wait', False)
         objs = kwargs.get('objects', [])
-        confirm = False
+        changed = []
         self.debug(objs)
         for obj in objs:
             self.info('Changing %s to %s state' % (obj.name, state, ))
+            confirm = False
             if state == 'running':
                 confirm = obj.power_on()
             elif state == 'stopped':
                 confirm = obj.power_off()
             else:
                 pass
-        # If waiting, only wait for the last one to change state
-        if confirm and wait:
-            self.info('Wait until instance(s) is/are in %s state' % (state,))
-            obj.poll_until(state)
+            if confirm:
+                changed.append(obj)
+        if changed and wait:
+            return self._wait_for_state(changed, state)
 
     def run_start(self, **kwargs):
         "Marshall over to _change_state"
@@ -151,15 +192,55 @@ class Ec2(script_helper.Script):
     def run_create(self, **kwargs):
         "Create one or more EC2 instance(s) (if not exist)"
         objs = kwargs.get('objects', [])
+        self.info('Attempting to create %s' % (', '.join([_.name for _ in objs]),))
+        results, errors = ec2_drivers.servers.create_many(objs, wait=False)
         for obj in objs:
-            try:
-                self.info('Attempting to create %s' % (obj.name,))
-                obj.create()
-            except Exception as e:
-                self.error('Error creating %s: %s' % (obj.name, e,))
+            if obj.name in errors:
+                self.error('Error creating %s: %s' % (obj.name, errors[obj.name],))
+        created = [_ for _ in objs if _.name in results]
         self.info('All objects created')
+        if created and kwargs.get('wait', False):
+            return self._wait_for_state(created, 'running')
         return
 
+    def run_destroy(self, **kwargs):
+        "Destroy one or more EC2 instance(s) and their volumes"
+        objs = kwargs.get('objects', [])
+        while True:
+            sys.stdout.write(
+                'Are you sure you want to destroy %s (yes/no)? ' % (
+                    ', '.join([_.name for _ in objs]),
+                )
+            )
+            line = sys.stdin.readline().rstrip('\r\n')
+            if line == 'no':
+                return 1
+            if line == 'yes':
+                break
+            sys.stdout.write('"yes" or "no", please\n')
+        # Always wait, volumes can only be deleted once they are detached
+        warnings, errors = ec2_drivers.servers.destroy_many(objs)
+        for obj in objs:
+            if obj.name in errors:
+                self.error('Error destroying %s: %s' % (obj.name, errors[obj.name],))
+            for warning in warnings.get(obj.name, []):
+                self.warn(warning)
+        self.info('Destroyed %s' % (', '.join(sorted(warnings.keys())),))
+        return errors and 1 or None
+
+    def run_find_ip(self, **kwargs):
+        "Prints the servers that own the given IP addresses or CIDR ranges"
+
+        try:
+            found = ec2_drivers.servers.find_by_ip(kwargs.get('addresses', []))
+        except ValueError as e:
+            self.error('Invalid address: %s' % (e,))
+            return 1
+        objs = dict([(k, sorted([_.name for _ in v])) for k, v in found.items()])
+        self.debug(objs)
+        cb = self.formatters[kwargs.get('format', 'pprint')]
+        print cb[0](objs, **cb[1])
+
     def _add_common_arguments(self, parser):
         parser.add_argument(
             '-k', '--aws-key', required=not os.environ.get('AWS_ACCESS_KEY_ID', False),
@@ -186,6 +267,8 @@ class Ec2(script_helper.Script):
             'start',
             'stop',
             'create',
+            'destroy',
+            'find-ip',
         )
         parser.add_argument(
             '-f', '--format', choices=formats, default='pprint',
@@ -193,7 +276,8 @@ class Ec2(script_helper.Script):
         )
         parser.add_argument(
             '--wait', action='store_true', default=False,
-            help='Wait for interaction with instances to finish (start/stop/create/destroy)'
+            help='Wait for interaction with instances to finish (start/stop/create), '
+            'destroy always waits'
         )
         parser.add_argument(
             '-p', '--pool', action='append', default=[],
@@ -204,13 +288,19 @@ class Ec2(script_helper.Script):
             help='Add new instance(s) to security group(s) (for create only). '
             'Keep in mind that security groups will be created if they don\'t exist'
         )
+        parser.add_argument(
+            '--stats', nargs='?', const='summary', choices=('summary', 'json'),
+            help='Print AWS request and database timings and throttling (to stderr) when done, '
+            'as a summary table (the default) or as JSON'
+        )
         parser.add_argument(
             'command', choices=cmds,
             help='EC2 command to run'
         )
         parser.add_argument(
             'instances', nargs='+', metavar='instance',
-            help='EC2 instance(s) to interact with'
+            help='EC2 instance(s) to interact with, or IP addresses and CIDR '
+            'ranges for find-ip'
         )
 
     def _add_arguments(self, parser):
@@ -219,7 +309,7 @@ class Ec2(script_helper.Script):
 
 def main():
     ec2, args = script_helper.init_arguments(Ec2)
-    return(ec2.run(args))
+    return(stats.run_script(ec2, args))
 
 if __name__ == '__main__':
     sys.exit(main())
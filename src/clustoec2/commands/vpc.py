@@ -30,6 +30,7 @@ except ImportError:
 from clusto import script_helper
 from clustoec2 import drivers as ec2_drivers
 from clustoec2.commands import ec2
+from clustoec2 import stats
 
 
 class Vpc(ec2.Ec2):
@@ -46,8 +47,8 @@ class Vpc(ec2.Ec2):
 
 
 def main():
-    ec2, args = script_helper.init_arguments(Vpc)
-    return(ec2.run(args))
+    vpc, args = script_helper.init_arguments(Vpc)
+    return(stats.run_script(vpc, args))
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -4,38 +4,194 @@
 # vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
 #
 
+from clusto.schema import Attribute
 from clustoec2.drivers.resourcemanagers import ec2connmanager
 from clustoec2.drivers.resourcemanagers import vpcconnmanager
+import threading
+import time
+
+# Seconds a described AWS object is reused before asking AWS again
+CACHE_TTL = 60
+
+
+class DescribeCache(object):
+    """
+    Process-wide cache of described AWS objects, keyed by
+    (region, kind, id). Entries expire after `ttl` seconds
+    """
+
+    def __init__(self, ttl=CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, region, kind, id):
+        key = (region, kind, id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.time():
+                return entry[1]
+            self._entries.pop(key, None)
+        return None
+
+    def set(self, region, kind, id, obj):
+        with self._lock:
+            self._entries[(region, kind, id)] = (time.time() + self.ttl, obj)
+
+    def invalidate(self, region=None, kind=None, id=None):
+        """
+        Drops the matching entries, or all of them if nothing is given
+        """
+
+        with self._lock:
+            for key in self._entries.keys():
+                if all([b is None or a == b for a, b in zip(key, (region, kind, id))]):
+                    del self._entries[key]
+
+
+describe_cache = DescribeCache()
+
+
+def prefetch(objects, name):
+    """
+    Describes the AWS objects of the given kind behind all the given
+    drivers with one (chunked) describe call per connection manager and
+    region and caches them. Returns a dictionary of driver name -> boto
+    object, or None if it couldn't be found
+    """
+
+    groups = {}
+    results = {}
+    for obj in objects:
+        results[obj.name] = None
+        info = obj._get_resource_info(name)
+        if not info:
+            continue
+        mgr, region, id = info
+        key = (mgr.name, region)
+        if key not in groups:
+            groups[key] = (mgr, {})
+        groups[key][1].setdefault(id, []).append(obj)
+
+    for (mgr_name, region), (mgr, ids) in groups.items():
+        for id, o in mgr.describe(name, ids.keys(), region).items():
+            describe_cache.set(region, name, id, o)
+            for obj in ids[id]:
+                results[obj.name] = o
+    return results
+
+
+class AttrSnapshot(object):
+    """
+    Immutable, ordered list of resolved (subkey, value) attribute pairs:
+    the object's own first and then the inherited ones, in the same order
+    merge_container_attrs would return them
+    """
+
+    def __init__(self, items):
+        self._items = tuple(items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def values(self, subkey):
+        return [v for k, v in self._items if k == subkey]
+
+    def value(self, subkey, default=None):
+        for k, v in self._items:
+            if k == subkey:
+                return v
+        return default
+
+
+def inherited_attrs(thing, key, cache=None):
+    """
+    Returns the (subkey, value) pairs for the given key that the given thing
+    inherits from all its containers, walking the hierarchy once. If a cache
+    dictionary is given, things with the same parents share the result
+    """
+
+    ids = tuple(sorted([_.entity.entity_id for _ in thing.parents()]))
+    if cache is not None and (key, ids) in cache:
+        return cache[(key, ids)]
+    items = []
+    parent_ids = list(ids)
+    while parent_ids:
+        items.extend([
+            (_.subkey, _.value) for _ in Attribute.query().filter(
+                Attribute.entity_id.in_(parent_ids)
+            ).filter(Attribute.key == key).all()
+        ])
+        parent_ids = [
+            _.entity_id for _ in Attribute.query().filter(
+                Attribute.relation_id.in_(parent_ids)
+            ).filter(Attribute.key == '_contains').all()
+        ]
+    items = tuple(items)
+    if cache is not None:
+        cache[(key, ids)] = items
+    return items
 
 
 class EC2Mixin(object):
 
-    _calls = {
-        'instance': 'get_all_instances',
-        'vpc': 'get_all_vpcs',
-        'subnet': 'get_all_subnets',
-    }
-    _o = None
+    _res_info = None
     _mgr_driver = ec2connmanager.EC2ConnectionManager
 
-    def _get_object(self, name, **kwargs):
-        if not self._o:
-            data = self.attr_value(
-                key='awsconnection',
-                subkey=name,
-            )
-            if not data:
-                return None
-            id = kwargs.get('id_key', '%s_id' % (name,))
-            id = data.get(id)
-            if not id:
-                return None
-            res = self._mgr_driver.resources(self)[0]
-            mgr = self._mgr_driver.get_resource_manager(res)
-            c = mgr._connection(res.value['region'])
-            rs = getattr(c, self._calls[name])([id], **kwargs)
-            self._o = rs[0]
-        return self._o
+    def _get_resource_info(self, name, id_key=None):
+        """
+        Returns a (manager, region, id) tuple that locates the AWS object
+        of the given kind, or None if this object hasn't been allocated
+        """
+
+        if self._res_info is None:
+            self._res_info = {}
+        if name in self._res_info:
+            return self._res_info[name]
+        data = self.attr_value(
+            key='awsconnection',
+            subkey=name,
+        )
+        if not data:
+            return None
+        id = data.get(id_key or '%s_id' % (name,))
+        if not id:
+            return None
+        res = self._mgr_driver.resources(self)[0]
+        mgr = self._mgr_driver.get_resource_manager(res)
+        self._res_info[name] = (mgr, res.value['region'], id)
+        return self._res_info[name]
+
+    def _attr_snapshot(self, key='aws', cache=None):
+        """
+        Returns an AttrSnapshot of this object's merged attributes for the
+        given key. Pass the same cache dictionary when resolving many objects
+        so the ones sharing parents only walk the hierarchy once
+        """
+
+        own = [(_.subkey, _.value) for _ in self.attrs(key=key)]
+        return AttrSnapshot(own + list(inherited_attrs(self, key, cache)))
+
+    def _get_object(self, name, id_key=None):
+        info = self._get_resource_info(name, id_key)
+        if not info:
+            return None
+        mgr, region, id = info
+        obj = describe_cache.get(region, name, id)
+        if obj is None:
+            obj = mgr.describe(name, [id], region).get(id)
+            if obj is not None:
+                describe_cache.set(region, name, id, obj)
+        return obj
+
+    def _invalidate_object(self, name):
+        """
+        Forgets the cached AWS object, call it after changing it in AWS
+        """
+
+        info = self._get_resource_info(name)
+        if info:
+            describe_cache.invalidate(info[1], name, info[2])
 
     def _get_state(self, name):
         return self._get_object(name).state
@@ -5,63 +5,440 @@
 #
 
 from boto.ec2 import blockdevicemapping
+import clusto
+from clusto.drivers.base import Driver
 from clusto.drivers.devices.servers import BasicVirtualServer
 from clusto.exceptions import ResourceException
+from clusto.schema import Attribute
+from clustoec2.drivers.base import describe_cache
 from clustoec2.drivers.base import EC2Mixin
-from datetime import datetime
+from clustoec2.drivers.base import prefetch
+from clustoec2.drivers.resourcemanagers.ec2connmanager import DEFAULT_WORKERS
+from clustoec2.drivers.resourcemanagers.ec2connmanager import DESCRIBE_CHUNK_SIZE
+from clustoec2.instancetypes import catalog
 import IPy
+import hashlib
 from mako import template
+from multiprocessing.pool import ThreadPool
 import os
+import random
+from sqlalchemy import or_
+import threading
 import time
 
 MAX_POLL_COUNT = 30
+# Upper bound (in seconds) for the backoff between polls
+MAX_POLL_INTERVAL = 30
+# RunInstances errors meaning the cached image metadata is stale
+DEREGISTERED_IMAGE_ERRORS = ('InvalidAMIID.NotFound', 'InvalidAMIID.Unavailable')
+# If set, compiled user data templates are stored as python modules in
+# this directory, so other processes don't have to compile them again
+TEMPLATE_MODULE_DIRECTORY = os.environ.get('CLUSTOEC2_TEMPLATE_DIR')
+
+# Compiled user data templates, keyed by the sha1 of their text
+_templates = {}
+# Boot script file contents, keyed by path: (mtime, contents)
+_boot_scripts = {}
+_cache_lock = threading.Lock()
+
+
+def _get_template(text, module_directory=None):
+    """
+    Returns the compiled mako template for the given text, compiling it
+    only the first time it is seen
+    """
+
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    key = hashlib.sha1(text).hexdigest()
+    with _cache_lock:
+        tpl = _templates.get(key)
+    if tpl is not None:
+        return tpl
+    module_directory = module_directory or TEMPLATE_MODULE_DIRECTORY
+    if module_directory:
+        # mako only reuses compiled modules for file based templates
+        filename = os.path.join(
+            os.path.abspath(module_directory), '%s.mako' % (key,)
+        )
+        if not os.path.isfile(filename):
+            if not os.path.isdir(module_directory):
+                os.makedirs(module_directory)
+            tmp = '%s.%d.tmp' % (filename, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(text)
+            os.rename(tmp, filename)
+        tpl = template.Template(
+            filename=filename, module_directory=module_directory,
+            uri='%s.mako' % (key,), input_encoding='utf-8'
+        )
+    else:
+        tpl = template.Template(text.decode('utf-8'))
+    with _cache_lock:
+        _templates[key] = tpl
+    return tpl
+
+
+def _read_boot_script(path):
+    """
+    Returns the contents of the given boot script file, or None if it
+    doesn't exist. Contents are re-read only when the file changes
+    """
+
+    if not os.path.isfile(path):
+        return None
+    mtime = os.path.getmtime(path)
+    with _cache_lock:
+        cached = _boot_scripts.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as f:
+        contents = f.read()
+    with _cache_lock:
+        _boot_scripts[path] = (mtime, contents)
+    return contents
+
+
+def wait_for_state(servers, state, until=True, interval=2,
+                   max_interval=MAX_POLL_INTERVAL, timeout=None):
+    """
+    Waits for all the given servers to reach the given state (or to leave
+    it if until is False). Every tick polls all the pending servers with one
+    DescribeInstances call per region, and ticks are spaced with a jittered
+    exponential backoff starting at `interval` seconds. Gives up after
+    `timeout` seconds (interval * MAX_POLL_COUNT by default).
+
+    Returns a (states, timeouts) tuple: a dictionary of server name -> last
+    seen state and the list of names that didn't get there in time
+    """
+
+    if timeout is None:
+        timeout = interval * MAX_POLL_COUNT
+    deadline = time.time() + timeout
+    pending = dict([(_.name, _) for _ in servers])
+    states = {}
+    delay = interval
+    while pending:
+        for name, instance in prefetch(pending.values(), 'instance').items():
+            states[name] = instance.state if instance else None
+            if (states[name] == state) == until:
+                pending.pop(name)
+        remaining = deadline - time.time()
+        if not pending or remaining <= 0:
+            break
+        time.sleep(min(random.uniform(delay / 2.0, delay), remaining))
+        delay = min(delay * 2, max_interval)
+    return (states, sorted(pending.keys()))
+
+
+def create_many(servers, wait=True):
+    """
+    Creates the instances for all the given servers. Servers that resolve
+    to identical launch parameters are started together with a single
+    RunInstances call, and if waiting, all the new instances are waited
+    for at once. Note that a user data template that renders the server
+    name makes every server's parameters different.
+
+    Returns a (results, errors) tuple of dictionaries keyed by server name.
+    A server whose instance was created but couldn't be tagged (i.e. AWS
+    doesn't know about the new instance yet) is in both
+    """
+
+    results = {}
+    errors = {}
+    groups = {}
+    # Servers sharing parents only resolve the inherited attributes once
+    inherited = {}
+    for server in servers:
+        try:
+            params = server._launch_params(inherited)
+        except Exception as e:
+            errors[server.name] = e
+            continue
+        groups.setdefault(params['key'], []).append((server, params))
+
+    for group in groups.values():
+        mgr = group[0][1]['mgr']
+        region = group[0][1]['region']
+        count = len(group)
+        image_id = group[0][1]['image_id']
+        try:
+            reservation = mgr._connection(region).run_instances(
+                image_id,
+                min_count=count,
+                max_count=count,
+                **group[0][1]['run_args']
+            )
+        except Exception as e:
+            if getattr(e, 'error_code', None) in DEREGISTERED_IMAGE_ERRORS:
+                mgr.forget_image(image_id, region)
+            for server, params in group:
+                errors[server.name] = e
+            continue
+
+        launched = zip(group, reservation.instances)
+        # Record every instance before anything else can fail, so none is
+        # left running without a clusto object
+        for (server, params), instance in launched:
+            describe_cache.set(region, 'instance', instance.id, instance)
+            result = mgr.additional_attrs(
+                server, resource={'instance': instance},
+                number=params['res'].number
+            )
+            results[server.name] = (result, True)
+        for (server, params), instance in launched:
+            try:
+                instance.add_tag('Name', server.name)
+            except Exception as e:
+                errors[server.name] = ResourceException(
+                    '%s was created as %s but could not be tagged: %s' % (
+                        server.name, instance.id, e,
+                    )
+                )
+
+    if wait and results:
+        wait_for_state([_ for _ in servers if _.name in results], 'running')
+    return (results, errors)
+
+
+def reconcile_ebs_fleet(servers, workers=DEFAULT_WORKERS):
+    """
+    Reconciles the EBS volumes of all the given servers at once. Every
+    region is scanned with one paginated DescribeVolumes, the volumes are
+    indexed by the instance they are attached to, and the actions for all
+    the servers are computed in memory. The AWS side is then applied by up
+    to `workers` threads, and all the clusto changes are written in a single
+    transaction at the end.
+
+    Returns a dictionary of server name -> exception for the servers that
+    could not be (fully) reconciled
+    """
+
+    errors = {}
+    regions = {}
+    instances = prefetch(servers, 'instance')
+    for server in servers:
+        instance = instances.get(server.name)
+        if instance is None:
+            errors[server.name] = ResourceException(
+                'This instance does not exist'
+            )
+            continue
+        mgr, region, id = server._get_resource_info('instance')
+        regions.setdefault((mgr.name, region), (mgr, region, []))[2].append(
+            (server, instance)
+        )
+
+    work = []
+    inherited = {}
+    for mgr, region, members in regions.values():
+        try:
+            volumes = dict([(_.id, _) for _ in mgr.get_volumes(region)])
+        except Exception as e:
+            for server, instance in members:
+                errors[server.name] = e
+            continue
+        attached = {}
+        for vol in volumes.values():
+            if vol.attach_data and vol.attach_data.instance_id:
+                attached.setdefault(vol.attach_data.instance_id, {})[vol.id] = vol
+        for server, instance in members:
+            recorded = server._recorded_ebs_volumes(
+                server._attr_snapshot(cache=inherited)
+            )
+            relevant = dict(attached.get(instance.id, {}))
+            for data in recorded.values():
+                if data.get('vol-id') in volumes:
+                    relevant[data['vol-id']] = volumes[data['vol-id']]
+            plan = server._plan_ebs_volumes(recorded, relevant, instance.id)
+            if plan:
+                work.append((server, mgr, region, instance, plan, []))
+
+    def run(item):
+        server, mgr, region, instance, plan, changes = item
+        try:
+            # Every worker thread uses its own connection
+            server._run_ebs_plan(
+                mgr._connection(region), instance.placement, instance.id,
+                plan, changes
+            )
+        except Exception as e:
+            return (server.name, e)
+        return (server.name, None)
+
+    if workers > 1 and len(work) > 1:
+        pool = ThreadPool(min(workers, len(work)))
+        try:
+            outcomes = pool.map(run, work)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        outcomes = [run(_) for _ in work]
+    for name, error in outcomes:
+        if error is not None:
+            errors[name] = error
+
+    if [_ for _ in work if _[5]]:
+        clusto.begin_transaction()
+        try:
+            for server, mgr, region, instance, plan, changes in work:
+                server._write_ebs_changes(changes)
+            clusto.commit()
+        except:
+            clusto.rollback_transaction()
+            raise
+    return errors
+
+
+def destroy_many(servers, wait=True, workers=DEFAULT_WORKERS):
+    """
+    Destroys the instances of all the given servers. Instances are
+    terminated with one (chunked) TerminateInstances call per region and
+    waited for all at once. Their volumes are then deleted by up to
+    `workers` threads, and the clusto entities of every terminated server
+    are deleted in a single transaction. Volumes can't be deleted while
+    attached, so if not waiting (or if an instance doesn't get to the
+    terminated state in time) its volumes and clusto entity are kept.
+    Volumes are found both by attachment and by the ids recorded in the
+    servers' ebs_* attributes, so destroying a server again deletes the
+    volumes a previous (not waited for) run left detached.
+
+    Returns a (warnings, errors) tuple of dictionaries keyed by server name:
+    the volumes that could not be deleted (or why they were kept), and the
+    servers that could not be terminated
+    """
+
+    errors = {}
+    warnings = {}
+    regions = {}
+    # volume id -> server, for the volumes recorded in clusto
+    recorded = {}
+    inherited = {}
+    instances = prefetch(servers, 'instance')
+    for server in servers:
+        if instances.get(server.name) is None:
+            errors[server.name] = ResourceException('This instance does not exist')
+            continue
+        mgr, region, id = server._get_resource_info('instance')
+        regions.setdefault((mgr.name, region), (mgr, region, {}))[2][id] = server
+        for data in server._recorded_ebs_volumes(
+            server._attr_snapshot(cache=inherited)
+        ).values():
+            if data.get('vol-id'):
+                recorded[data['vol-id']] = server
+
+    terminated = []
+    volumes = []
+    for mgr, region, members in regions.values():
+        conn = mgr._connection(region)
+        ids = sorted(members.keys())
+        for i in range(0, len(ids), DESCRIBE_CHUNK_SIZE):
+            chunk = ids[i:i + DESCRIBE_CHUNK_SIZE]
+            names = set([members[_].name for _ in chunk])
+            vol_ids = sorted([k for k, v in recorded.items() if v.name in names])
+            try:
+                found = mgr.get_volumes(
+                    region, filters={'attachment.instance-id': chunk}
+                )
+                for j in range(0, len(vol_ids), DESCRIBE_CHUNK_SIZE):
+                    found.extend(mgr.get_volumes(
+                        region,
+                        filters={'volume-id': vol_ids[j:j + DESCRIBE_CHUNK_SIZE]}
+                    ))
+                conn.terminate_instances(instance_ids=chunk)
+            except Exception as e:
+                for id in chunk:
+                    errors[members[id].name] = e
+                continue
+            for id in chunk:
+                describe_cache.invalidate(region, 'instance', id)
+                terminated.append(members[id])
+            seen = set()
+            for vol in found:
+                if vol.id in seen:
+                    continue
+                seen.add(vol.id)
+                attached_to = vol.attach_data and vol.attach_data.instance_id
+                # Leave alone recorded volumes now used by other instances
+                if attached_to and attached_to not in members:
+                    continue
+                volumes.append(
+                    (members.get(attached_to) or recorded[vol.id], mgr, region, vol)
+                )
+
+    if not wait:
+        for server in terminated:
+            warnings[server.name] = [
+                'Not waiting for %s to terminate, its volumes and clusto '
+                'object were kept' % (server.name,)
+            ]
+        return (warnings, errors)
+
+    if terminated:
+        states, timeouts = wait_for_state(terminated, 'terminated')
+        for name in timeouts:
+            errors[name] = ResourceException(
+                '%s did not reach the terminated state in time (last seen %s), '
+                'its volumes and clusto object were kept' % (
+                    name, states.get(name),
+                )
+            )
+        terminated = [_ for _ in terminated if _.name not in timeouts]
+        volumes = [_ for _ in volumes if _[0].name not in timeouts]
+
+    # destroy all volumes
+    def delete(item):
+        server, mgr, region, vol = item
+        dev = (vol.attach_data and vol.attach_data.device or '').split('/')[-1]
+        # It could be that some instances haven't freed their volumes
+        try:
+            mgr._connection(region).delete_volume(vol.id)
+        except Exception as e:
+            return (
+                server.name,
+                'Could not delete volume %(dev)s (%(id)s) '
+                'from %(name)s, reason: %(reason)s' % {
+                    'dev': dev,
+                    'id': vol.id,
+                    'name': server.name,
+                    'reason': getattr(e, 'error_message', e)
+                }
+            )
+        return (server.name, None)
+
+    if workers > 1 and len(volumes) > 1:
+        pool = ThreadPool(min(workers, len(volumes)))
+        try:
+            outcomes = pool.map(delete, volumes)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        outcomes = [delete(_) for _ in volumes]
+    for server in terminated:
+        warnings[server.name] = []
+    for name, warning in outcomes:
+        if warning:
+            warnings[name].append(warning)
+
+    # finally, delete the entities from clustometa
+    if terminated:
+        clusto.begin_transaction()
+        try:
+            for server in terminated:
+                server.entity.delete()
+            clusto.commit()
+        except:
+            clusto.rollback_transaction()
+            raise
+    return (warnings, errors)
 
 
 class EC2VirtualServer(BasicVirtualServer, EC2Mixin):
 
     _driver_name = 'ec2virtualserver'
-    _i = None
     _int_ip_const = 2147483648
-    # non-listed instances will get 0 ephemeral drives at spin-up time
-    _eph_drives = {
-        'c1.medium': 1,
-        'c1.xlarge': 4,
-        'c3.large': 2,
-        'c3.xlarge': 2,
-        'c3.4xlarge': 2,
-        'c3.8xlarge': 2,
-        'cc2.8xlarge': 4,
-        'cg1.4xlarge': 2,
-        'cr1.8xlarge': 2,
-        'd2.xlarge': 3,
-        'd2.2xlarge': 6,
-        'd2.4xlarge': 12,
-        'd2.8xlarge': 24,
-        'g2.2xlarge': 1,
-        'g2.8xlarge': 2,
-        'hi1.4xlarge': 2,
-        'hs1.8xlarge': 24,
-        'i2.xlarge': 1,
-        'i2.2xlarge': 2,
-        'i2.4xlarge': 4,
-        'i2.8xlarge': 8,
-        'm1.small': 1,
-        'm1.medium': 1,
-        'm1.large': 2,
-        'm1.xlarge': 4,
-        'm2.xlarge': 1,
-        'm2.2xlarge': 1,
-        'm2.4xlarge': 2,
-        'm3.medium': 1,
-        'm3.large': 1,
-        'm3.xlarge': 2,
-        'm3.2xlarge': 2,
-        'r3.large': 1,
-        'r3.xlarge': 1,
-        'r3.2xlarge': 1,
-        'r3.4xlarge': 1,
-        'r3.8xlarge': 2,
-    }
 
     def _int_to_ipy(self, num):
         return IPy.IP(num + self._int_ip_const)
@@ -71,9 +448,7 @@ class EC2VirtualServer(BasicVirtualServer, EC2Mixin):
         Returns a boto.ec2.Instance object to work with
         """
 
-        reservation = self._get_object('instance')
-        if reservation:
-            return reservation.instances[0]
+        return self._get_object('instance')
 
     def console(self, *args, **kwargs):
         """
@@ -121,9 +496,20 @@ class EC2VirtualServer(BasicVirtualServer, EC2Mixin):
         Updates the IP attributes for this instance
         """
 
-        self.clear_metadata()
         self._get_instance().update()
-        ip = self._get_instance().private_ip_address
+        self.set_ip_metadata(
+            self._get_instance().private_ip_address,
+            self._get_instance().ip_address
+        )
+
+    def set_ip_metadata(self, private_ip=None, public_ip=None):
+        """
+        Replaces the IP attributes for this instance with the given
+        addresses, for callers that already have the instance data
+        """
+
+        self.clear_metadata()
+        ip = private_ip
         if ip:
             self.add_attr(
                 key='ip',
@@ -137,7 +523,7 @@ class EC2VirtualServer(BasicVirtualServer, EC2Mixin):
                 value=ip,
                 number=0
             )
-        ip = self._get_instance().ip_address
+        ip = public_ip
         if ip:
             self.add_attr(
                 key='ip',
@@ -162,94 +548,103 @@ class EC2VirtualServer(BasicVirtualServer, EC2Mixin):
         if captcha and not self._power_captcha('shutdown'):
             return False
         self._get_instance().stop()
+        self._invalidate_object('instance')
         return True
 
     def power_on(self, captcha=False):
         if captcha and not self._power_captcha('start'):
             return False
         self._get_instance().start()
+        self._invalidate_object('instance')
         return True
 
     def power_reboot(self, captcha=True):
         if captcha and not self._power_captcha('reboot'):
             return False
         self._get_instance().reboot()
+        self._invalidate_object('instance')
 
-    def _build_user_data(self, udata=None):
+    def _build_user_data(self, udata=None, attrs=None):
         """
         Builds and returns a userdata string based on the
-        user data string attribute
+        user data string attribute. Takes an optional AttrSnapshot
+        of the aws attributes to avoid resolving them again
         """
 
-        udata = self.attr_value(
-            key='aws', subkey='ec2_user_data',
-            merge_container_attrs=True
-        )
+        if attrs is None:
+            attrs = self._attr_snapshot()
+        udata = attrs.value('ec2_user_data')
 
         if udata:
-            tpl = template.Template(udata)
+            tpl = _get_template(udata)
             # Always send the name of this object
             attr_dict = {
                 'name': self.name,
             }
             # Add all aws information as values
-            for attr in self.attrs(key='aws', merge_container_attrs=True):
+            for subkey, value in attrs:
                 # don't recurse
-                if attr.subkey == 'ec2_user_data':
+                if subkey == 'ec2_user_data':
                     continue
-                if attr.subkey == 'ec2_boot_script_file':
-                    if os.path.isfile(attr.value):
-                        f = open(attr.value, 'rb')
-                        attr_dict[attr.subkey] = f.read()
-                        f.close()
+                if subkey == 'ec2_boot_script_file':
+                    contents = _read_boot_script(value)
+                    if contents is not None:
+                        attr_dict[subkey] = contents
                 else:
-                    attr_dict[attr.subkey] = attr.value
+                    attr_dict[subkey] = value
             attr_dict.update({'name': self.name, })
             return tpl.render(**attr_dict)
         else:
             return None
 
-    def _ephemeral_storage(self, instance_type):
+    def _ephemeral_storage(self, instance_type, image=None):
         """
         Return the appropriate block mapping so you
-        get your ephemeral storage drives
+        get your ephemeral storage drives, instance types
+        missing from the catalog get none. Given the image
+        metadata, drives the image already maps are left out
+        and the devices it uses (root included) are skipped
         """
 
-        number = self._eph_drives.get(instance_type, 0)
+        image = image or {}
+        image_mapping = image.get('block_device_mapping') or {}
+        mapped = set([
+            _['ephemeral_name'] for _ in image_mapping.values()
+            if _.get('ephemeral_name')
+        ])
+        taken = set([
+            _.replace('/dev/xvd', '/dev/sd')[:8]
+            for _ in image_mapping.keys() + [image.get('root_device_name') or '']
+        ])
+        letters = [
+            _ for _ in 'bcdefghijklmnopqrstuvwxyz'
+            if '/dev/sd%s' % (_,) not in taken
+        ]
+        number = catalog.ephemeral_drives(instance_type)
         mapping = blockdevicemapping.BlockDeviceMapping()
         for block in range(0, number):
+            if 'ephemeral%d' % (block,) in mapped or not letters:
+                continue
             eph = blockdevicemapping.BlockDeviceType()
             eph.ephemeral_name = 'ephemeral%d' % (block, )
-            mapping['/dev/sd%s' % (chr(ord('b') + block),)] = eph
+            mapping['/dev/sd%s' % (letters.pop(0),)] = eph
         return mapping
 
-    def _get_or_create_security_groups(self, conn, vpc_id=None):
+    def _get_or_create_security_groups(self, mgr, region, vpc_id=None, attrs=None):
         """
         If security groups don't exist, they will get created. Results will
-        be returned to calling argument. It receives the current connection
-        used as a parameter
+        be returned to calling argument. Groups are looked up in (and added
+        to) the manager's security group index for the region
         """
 
+        if attrs is None:
+            attrs = self._attr_snapshot()
         # We gotta search for both, because if they don't exist you'll have to create them
-        sgs_ids = self.attr_values(
-            key='aws',
-            subkey='ec2_security_group_id',
-            merge_container_attrs=True
-        )
-        sgs_names = self.attr_values(
-            key='aws',
-            subkey='ec2_security_group',
-            merge_container_attrs=True
-        )
-        filters = {}
+        sgs_ids = attrs.values('ec2_security_group_id')
+        sgs_names = attrs.values('ec2_security_group')
         # If you received a vpc_id then only return those from that vpc
         # Also if you received a vpc_id, you must return ids
-        ids = False
-        if vpc_id:
-            filters['vpc-id'] = vpc_id
-            ids = True
-        existing_groups = dict([(_.id, _.name) for _ in conn.get_all_security_groups(filters=filters)])
-        final_groups = set()
+        existing_groups = mgr.get_security_groups(region, vpc_id=vpc_id)
 
         # If you have a security group id that doesn't exist in aws (???) bail out
         diff = set(sgs_ids) - set(existing_groups.keys())
@@ -259,28 +654,25 @@ class EC2VirtualServer(BasicVirtualServer, EC2Mixin):
                 'found in amazon, where did you find them?' % (','.join(diff),)
             )
 
-        # I need the two items otherwise I'd do this with sets
-        for sg in sgs_ids:
-            [final_groups.add((k, v)) for k, v in existing_groups.iteritems() if k == sg]
+        final_groups = dict([(_, existing_groups[_]) for _ in sgs_ids])
 
         # Next search based on the group name. It is possible group names don't exist
-        # in aws (new group) so you have to create those.
+        # in aws (new group) so those get created.
         for sg in sgs_names:
-            if sg not in existing_groups.values():
-                desc = 'Created on %s' % (datetime.now(),)
-                group = conn.create_security_group(name=sg, description=desc)
-                final_groups.add((group.id, group.name))
-            [final_groups.add((k, v)) for k, v in existing_groups.iteritems() if v == sg]
-
-        final_groups = dict(final_groups)
-        if ids:
+            final_groups[mgr.get_or_create_security_group(sg, region, vpc_id=vpc_id)] = sg
+
+        if vpc_id:
             return final_groups.keys()
         else:
             return final_groups.values()
 
-    def create(self, captcha=False, wait=True):
+    def _launch_params(self, inherited=None):
         """
-        Creates an instance if it isn't already created
+        Resolves everything needed to launch this instance. Returns a
+        dictionary with the manager, resource, region, image id and the
+        image.run() arguments, plus a `key` that is the same for every
+        server launched with identical parameters. `inherited` is the
+        cache of inherited attributes shared by a batch of servers
         """
 
         try:
@@ -300,14 +692,16 @@ class EC2VirtualServer(BasicVirtualServer, EC2Mixin):
             'ec2_user_data'
         ]
 
+        # Resolve the aws attributes once for everything below
+        attrs = self._attr_snapshot(cache=inherited)
+
         # Grab all the `ec2_*` attributes available
         ec2_attrs = dict(
             [
-                (_.subkey, _.value) for _ in self.attrs(
-                    key='aws', merge_container_attrs=True
-                ) if _.subkey
-                and _.subkey.startswith('ec2_')
-                and _.subkey not in skip_attrs
+                (subkey, value) for subkey, value in attrs
+                if subkey
+                and subkey.startswith('ec2_')
+                and subkey not in skip_attrs
             ]
         )
 
@@ -330,21 +724,19 @@ class EC2VirtualServer(BasicVirtualServer, EC2Mixin):
             )
 
         placement = ec2_attrs.pop('ec2_placement', None)
-        user_data = self._build_user_data()
+        user_data = self._build_user_data(attrs=attrs)
         key_name = ec2_attrs.pop('ec2_key_name', None)
 
-        image = mgr._connection(region).get_image(image_id)
         # Unless you explicitly skip the creation of ephemeral drives, these
         # will get created, you're already paying for them after all
         block_mapping = None
+        image = mgr.get_image_info(image_id, region)
         skip_ephemeral = ec2_attrs.pop('ec2_skip_ephemeral', False)
         if not skip_ephemeral:
-            block_mapping = self._ephemeral_storage(instance_type)
+            block_mapping = self._ephemeral_storage(instance_type, image)
 
         # Now we need to check if this is vpc or not
-        vpc_id = self.attr_value(
-            key='aws', subkey='vpc_id', merge_container_attrs=True, default=None
-        )
+        vpc_id = attrs.value('vpc_id')
 
         extra_args = dict(
             ('_'.join(_.split('_')[1:]), __) for _, __ in ec2_attrs.items()
@@ -352,53 +744,67 @@ class EC2VirtualServer(BasicVirtualServer, EC2Mixin):
 
         if vpc_id:
             security_group_ids = self._get_or_create_security_groups(
-                mgr._connection(region), vpc_id=vpc_id
+                mgr, region, vpc_id=vpc_id, attrs=attrs
             )
-            extra_args['security_group_ids'] = security_group_ids
+            extra_args['security_group_ids'] = sorted(security_group_ids)
         else:
             security_groups = self._get_or_create_security_groups(
-                mgr._connection(region)
+                mgr, region, attrs=attrs
             )
-            extra_args['security_groups'] = security_groups
-
-        reservation = image.run(
-            instance_type=instance_type,
-            placement=placement,
-            key_name=key_name,
-            user_data=user_data,
-            block_device_map=block_mapping,
-            **extra_args
-        )
+            extra_args['security_groups'] = sorted(security_groups)
+
+        extra_args.update({
+            'instance_type': instance_type,
+            'placement': placement,
+            'key_name': key_name,
+            'user_data': user_data,
+        })
+        key = repr((
+            mgr.name, region, image_id, bool(skip_ephemeral),
+            sorted(extra_args.items())
+        ))
+        extra_args['block_device_map'] = block_mapping
+        return {
+            'key': key,
+            'mgr': mgr,
+            'res': res,
+            'region': region,
+            'image_id': image_id,
+            'run_args': extra_args,
+        }
 
-        self._i = reservation.instances[0]
-        self._i.add_tag('Name', self.name)
-        result = mgr.additional_attrs(self, resource={'instance': self._i}, number=res.number)
-        if wait:
-            self.poll_until('running')
+    def create(self, captcha=False, wait=True):
+        """
+        Creates an instance if it isn't already created
+        """
 
-        return (result, True)
+        results, errors = create_many([self], wait=wait)
+        if self.name in errors:
+            raise errors[self.name]
+        return results[self.name]
 
     def poll_until(self, state, interval=2, max_poll=MAX_POLL_COUNT):
         """
         Polls for the requested status, with a possible timeout.
-        Shamelessly stolen from py-smartdc
+        Returns whether the status was reached
         """
 
-        c = 0
-        while self.state != state and c < max_poll:
-            c += 1
-            time.sleep(interval)
+        states, timeouts = wait_for_state(
+            [self], state, interval=interval, timeout=interval * max_poll
+        )
+        return not timeouts
 
     def poll_while(self, state, interval=2, max_poll=MAX_POLL_COUNT):
         """
-        Polls whil the status doesn't change, with a possible timeout.
-        Shamelessly stolen from py-smartdc
+        Polls while the status doesn't change, with a possible timeout.
+        Returns whether the status changed
         """
 
-        c = 0
-        while self.state == state and c < max_poll:
-            c += 1
-            time.sleep(interval)
+        states, timeouts = wait_for_state(
+            [self], state, until=False, interval=interval,
+            timeout=interval * max_poll
+        )
+        return not timeouts
 
     def destroy(self, captcha=True, wait=True):
         """
@@ -407,122 +813,151 @@ class EC2VirtualServer(BasicVirtualServer, EC2Mixin):
         if captcha and not self._power_captcha('destroy'):
             return False
 
-        try:
-            assert self._instance
-        except AssertionError:
-            raise ResourceException('This instance does not exist')
-        except:
-            pass
-
-        instance_id = self._get_instance().id
-        volumes = self._get_instance().connection.get_all_volumes(
-            filters={'attachment.instance-id': instance_id})
-        self._get_instance().terminate()
-        if wait:
-            self.poll_until('terminated')
-        # destroy all volumes
-        warnings = []
-        for vol in volumes:
-            dev = vol.attach_data.device.split('/')[-1]
-            # It could be that some instances haven't freed their volumes
-            try:
-                vol.delete()
-            except Exception as e:
-                warnings.append(
-                    'Could not delete volume %(dev)s (%(id)s) '
-                    'from %(name)s, reason: %(reason)s' % {
-                        'dev': dev,
-                        'id': vol.id,
-                        'name': self.name,
-                        'reason': e.error_message
-                    }
-                )
+        warnings, errors = destroy_many([self], wait=wait)
+        if self.name in errors:
+            raise errors[self.name]
+        return warnings[self.name]
 
-        # finally, delete the entity from clustometa
-        self.entity.delete()
-        return warnings
-
-    def reconcile_ebs_volumes(self):
+    def _recorded_ebs_volumes(self, attrs=None):
         """
-        Will reflect the changes from amazon in clusto first,
-        whatever's left from clusto to amazon
+        Returns the EBS volumes recorded in clusto as a dictionary of
+        device -> {'size', 'vol-id', 'extra'}
         """
 
+        if attrs is None:
+            attrs = self._attr_snapshot()
         volumes = {}
-        conn = self._get_instance().connection
-        # Seems important to grab the placement from the instance data in the
-        # unlikely scenario the clusto data doesn't match?
-        zone = self._get_instance().placement
-        instance_id = self._get_instance().id
-        for attr in self.attrs(key='aws', merge_container_attrs=True):
-            if not attr.subkey.startswith('ebs_'):
+        for subkey, value in attrs:
+            if not subkey or not subkey.startswith('ebs_'):
                 continue
-            volume = '_'.join(attr.subkey.split('_')[1:])
+            volume = '_'.join(subkey.split('_')[1:])
             if volume not in volumes.keys():
                 volumes[volume] = {}
             try:
-                volumes[volume]['size'] = int(attr.value)
+                volumes[volume]['size'] = int(value)
             except ValueError:
-                if attr.value.startswith('vol-'):
-                    volumes[volume]['vol-id'] = attr.value
+                if value.startswith('vol-'):
+                    volumes[volume]['vol-id'] = value
                 else:
-                    volumes[volume]['extra'] = attr.value
+                    volumes[volume]['extra'] = value
+        return volumes
 
-        for dev, data in volumes.items():
-            device = '/dev/%s' % (dev, )
-            vol = None
+    def _plan_ebs_volumes(self, recorded, volumes, instance_id):
+        """
+        Computes, in memory, what it takes to reconcile the recorded EBS
+        volumes with AWS. `volumes` is a dictionary of volume id -> boto
+        Volume that has to include every volume attached to the instance.
+        Returns a list of (action, device, value) tuples, where action is
+        one of create (size), attach (volume), forget, record (volume) and
+        tag (volume)
+        """
+
+        plan = []
+        for dev, data in recorded.items():
             if 'vol-id' not in data.keys():
-                # create the volumes w/ default size of 10G
-                vol = conn.create_volume(int(data['size']), zone)
-                self.add_attr(
-                    key='aws',
-                    subkey='ebs_%s' % (dev,), value=vol.id
-                )
-            else:
-                try:
-                    vol = conn.get_all_volumes(volume_ids=[data['vol-id']])
-                    vol = vol[0]
-                except:
-                    # This volume does not exist anymore
-                    self.del_attrs(key='aws', subkey='ebs_%s' % (dev,))
-            if vol:
-                # Attach the volume if it's not attached
-                if not vol.attachment_state():
-                    vol.attach(instance_id, device)
-                else:
-                    # Ok so it's attached, but what if it's attached to something
-                    # else? if that is the case we should clear the attrs
-                    try:
-                        is_mine = conn.get_all_volumes(
-                            volume_ids=[data['vol-id']],
-                            filters={'attachment.instance-id': instance_id})
-                    except:
-                        is_mine = False
-                    if is_mine:
-                        vol.add_tag('Name', '%s:%s' % (self.name, device,))
-                    else:
-                        self.del_attrs(key='aws', subkey='ebs_%s' % (dev,))
+                plan.append(('create', dev, int(data['size'])))
+                continue
+            vol = volumes.get(data['vol-id'])
+            if not vol:
+                # This volume does not exist anymore
+                plan.append(('forget', dev, None))
+            elif not vol.attachment_state():
+                plan.append(('attach', dev, vol))
+            elif vol.attach_data.instance_id != instance_id:
+                # Ok so it's attached, but to something else
+                plan.append(('forget', dev, None))
 
         # Ok so now from aws to clusto
-        volumes = conn.get_all_volumes(
-            filters={'attachment.instance-id': instance_id})
-
-        for vol in volumes:
+        for vol in volumes.values():
+            if not vol.attach_data or vol.attach_data.instance_id != instance_id:
+                continue
             device = vol.attach_data.device
             dev = device.split('/')[-1]
             # update attrs that are not in our db
             if not self.attrs(key='aws', subkey='ebs_%s' % (dev,)):
-                self.add_attr(
-                    key='aws', subkey='ebs_%s' % (dev,),
-                    value=int(vol.size)
-                )
-                self.add_attr(
-                    key='aws', subkey='ebs_%s' % (dev,),
-                    value=vol.id
-                )
-            tag = '%s:%s' % (self.name, device)
-            if 'Name' not in vol.tags or vol.tags['Name'] != tag:
-                vol.add_tag('Name', tag)
+                plan.append(('record', dev, vol))
+            if vol.tags.get('Name') != '%s:%s' % (self.name, device):
+                plan.append(('tag', dev, vol))
+        return plan
+
+    def _run_ebs_plan(self, conn, zone, instance_id, plan, changes):
+        """
+        Applies the AWS side of a plan from _plan_ebs_volumes, appending
+        the clusto attribute changes it requires to `changes` as it goes
+        (so a failure midway still records the volumes it created). Name
+        tags are written with one CreateTags call per distinct value. Does
+        not touch clusto, so it is safe to run in a worker thread
+        """
+
+        tags = {}
+        for action, dev, value in plan:
+            device = '/dev/%s' % (dev, )
+            subkey = 'ebs_%s' % (dev,)
+            if action == 'create':
+                value = conn.create_volume(value, zone)
+                changes.append(('add', subkey, value.id))
+                action = 'attach'
+            if action == 'attach':
+                conn.attach_volume(value.id, instance_id, device)
+                tags.setdefault('%s:%s' % (self.name, device), []).append(value.id)
+            elif action == 'forget':
+                changes.append(('del', subkey, None))
+            elif action == 'record':
+                changes.append(('add', subkey, int(value.size)))
+                changes.append(('add', subkey, value.id))
+            elif action == 'tag':
+                tag = '%s:%s' % (self.name, value.attach_data.device)
+                tags.setdefault(tag, []).append(value.id)
+        for tag, ids in tags.items():
+            conn.create_tags(ids, {'Name': tag})
+
+    def _write_ebs_changes(self, changes):
+        """
+        Writes the clusto attribute changes collected by _run_ebs_plan
+        """
+
+        for change, subkey, value in changes:
+            if change == 'add':
+                self.add_attr(key='aws', subkey=subkey, value=value)
+            else:
+                self.del_attrs(key='aws', subkey=subkey)
+
+    def reconcile_ebs_volumes(self):
+        """
+        Will reflect the changes from amazon in clusto first,
+        whatever's left from clusto to amazon. All the volumes
+        involved are described up front, usually in a single call
+        """
+
+        instance = self._get_instance()
+        conn = instance.connection
+        # Seems important to grab the placement from the instance data in the
+        # unlikely scenario the clusto data doesn't match?
+        zone = instance.placement
+        instance_id = instance.id
+        recorded = self._recorded_ebs_volumes()
+
+        volumes = dict([
+            (_.id, _) for _ in conn.get_all_volumes(
+                filters={'attachment.instance-id': instance_id}
+            )
+        ])
+        # Recorded volumes that are attached elsewhere (or nowhere), the
+        # filter doesn't fail on ids that don't exist anymore
+        missing = [
+            _['vol-id'] for _ in recorded.values()
+            if 'vol-id' in _ and _['vol-id'] not in volumes
+        ]
+        if missing:
+            for vol in conn.get_all_volumes(filters={'volume-id': missing}):
+                volumes[vol.id] = vol
+
+        plan = self._plan_ebs_volumes(recorded, volumes, instance_id)
+        changes = []
+        try:
+            self._run_ebs_plan(conn, zone, instance_id, plan, changes)
+        finally:
+            self._write_ebs_changes(changes)
 
     def _get_instance_state(self):
         return self._get_instance().update()
@@ -531,3 +966,46 @@ class EC2VirtualServer(BasicVirtualServer, EC2Mixin):
     state = property(lambda self: self._get_instance_state())
     private_ips = property(lambda self: self.get_private_ips())
     public_ips = property(lambda self: self.get_public_ips())
+
+
+def find_by_ip(addresses):
+    """
+    Resolves IP addresses and/or CIDR ranges to EC2 servers through the ip
+    attributes set by set_ip_metadata, with a single indexed query for the
+    whole batch. Returns a dictionary of address -> list of servers (private
+    addresses can repeat across VPCs), unknown addresses are left out
+    """
+
+    const = EC2VirtualServer._int_ip_const
+    values = []
+    clauses = []
+    for address in addresses:
+        ip = IPy.IP(address, make_net=True)
+        if ip.len() == 1:
+            values.append(ip.int() - const)
+        else:
+            clauses.append(Attribute.int_value.between(
+                ip[0].int() - const, ip[-1].int() - const
+            ))
+    if values:
+        clauses.append(Attribute.int_value.in_(values))
+    if not clauses:
+        return {}
+
+    attrs = Attribute.query().filter(
+        Attribute.key == 'ip'
+    ).filter(
+        Attribute.subkey.in_(['nic-eth', 'ext-eth'])
+    ).filter(or_(*clauses)).all()
+
+    results = {}
+    servers = {}
+    for attr in attrs:
+        if attr.entity_id not in servers:
+            servers[attr.entity_id] = Driver(attr.entity)
+        server = servers[attr.entity_id]
+        if not isinstance(server, EC2VirtualServer):
+            continue
+        ip = IPy.IP(attr.value + const).strNormal()
+        results.setdefault(ip, []).append(server)
+    return results
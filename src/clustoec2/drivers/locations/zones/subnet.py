@@ -6,6 +6,80 @@
 
 from clusto.drivers.locations.zones import BasicZone
 from clustoec2.drivers.base import VPCMixin
+from clustoec2.drivers.devices.servers import ec2server
+import IPy
+
+# AWS reserves the first four and the last address of every subnet
+RESERVED_OFFSETS = (0, 1, 2, 3, -1)
+
+
+class AddressMap(object):
+    """
+    Bitmap of the used addresses in a network. Free counts and utilization
+    are kept up to date as addresses are marked, the next free address is
+    found with a single operation over the bitmap
+    """
+
+    def __init__(self, cidr, reserved=RESERVED_OFFSETS):
+        self.network = IPy.IP(cidr)
+        self.size = self.network.len()
+        self._bits = 0
+        self._used = 0
+        for offset in reserved:
+            self._mark(offset % self.size)
+
+    def _mark(self, offset):
+        bit = 1 << offset
+        if not self._bits & bit:
+            self._bits |= bit
+            self._used += 1
+
+    def _offset(self, ip):
+        offset = IPy.IP(ip).int() - self.network.int()
+        if 0 <= offset < self.size:
+            return offset
+        return None
+
+    def add(self, ip):
+        """
+        Marks the given address as used, returns False if it
+        doesn't belong to this network
+        """
+
+        offset = self._offset(ip)
+        if offset is None:
+            return False
+        self._mark(offset)
+        return True
+
+    def __contains__(self, ip):
+        offset = self._offset(ip)
+        return offset is not None and bool(self._bits & (1 << offset))
+
+    def next_free(self):
+        """
+        Returns the lowest free address, or None if the network is full
+        """
+
+        # Only the lowest zero bit survives
+        offset = (~self._bits & (self._bits + 1)).bit_length() - 1
+        if offset >= self.size:
+            return None
+        return IPy.IP(self.network.int() + offset).strNormal()
+
+    def take(self):
+        """
+        Returns the lowest free address and marks it as used
+        """
+
+        ip = self.next_free()
+        if ip:
+            self.add(ip)
+        return ip
+
+    used = property(lambda self: self._used)
+    free = property(lambda self: self.size - self._used)
+    utilization = property(lambda self: float(self._used) / self.size)
 
 
 class VPCSubnet(BasicZone, VPCMixin):
@@ -34,6 +108,29 @@ class VPCSubnet(BasicZone, VPCMixin):
     def get_cidr_block(self):
         return self._get_subnet().cidr_block
 
+    def address_map(self, clusto=True, aws=True):
+        """
+        Returns an AddressMap of this subnet's used addresses, built from
+        the clusto ip attributes in the subnet range (one query) and/or
+        the subnet's network interfaces (one DescribeNetworkInterfaces
+        call). Other VPCs reusing the same range can only make the map
+        more conservative
+        """
+
+        subnet = self._get_subnet()
+        amap = AddressMap(subnet.cidr_block)
+        if clusto:
+            for ip in ec2server.find_by_ip([subnet.cidr_block]):
+                amap.add(ip)
+        if aws:
+            mgr, region, id = self._get_resource_info('subnet')
+            for eni in mgr._connection(region).get_all_network_interfaces(
+                filters={'subnet-id': id}
+            ):
+                for address in eni.private_ip_addresses:
+                    amap.add(address.private_ip_address)
+        return amap
+
     _subnet = property(lambda self: self._get_subnet())
     state = property(lambda self: self._get_state('subnet'))
     cidr_block = property(lambda self: self.get_cidr_block())
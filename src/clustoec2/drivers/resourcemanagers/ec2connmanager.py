@@ -8,36 +8,182 @@ from boto import ec2
 from clusto import get_entities
 from clusto.drivers.base import ResourceManager
 from clusto.exceptions import ResourceException
+from clustoec2.ratelimit import limiter
+from datetime import datetime
+import httplib
+import json
+import logging
+import os
+from multiprocessing.pool import ThreadPool
+import Queue
+import socket
+import threading
+import time
+
+# AWS accepts at most 200 values per describe filter
+DESCRIBE_CHUNK_SIZE = 200
+# How many regions are queried at the same time by default
+DEFAULT_WORKERS = 8
+# Instances per DescribeInstances page (AWS allows 5 to 1000)
+PAGE_SIZE = 1000
+# DescribeVolumes doesn't take pages bigger than this
+VOLUME_PAGE_SIZE = 500
+# Seconds a pooled connection can sit unused before it is closed
+MAX_IDLE = 300
+# Request failures after which a connection is not reused
+CONNECTION_ERRORS = (socket.error, httplib.HTTPException)
+# Seconds a region's security group index is trusted before re-describing
+SG_INDEX_TTL = 300
 
 
 class EC2ConnManagerException(ResourceException):
     pass
 
 
+def close_connection(conn):
+    """
+    Closes the HTTP connections a boto connection keeps alive, boto's own
+    close() only forgets the last one used
+    """
+
+    pool = getattr(conn, '_pool', None)
+    if pool is not None:
+        with pool.mutex:
+            hosts = pool.host_to_pool.values()
+            pool.host_to_pool = {}
+        for host in hosts:
+            for http_conn, _ in host.queue:
+                http_conn.close()
+    conn.close()
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of AWS connections. boto connections can't be shared
+    between threads, so every thread gets its own connection per key, which
+    boto keeps alive between calls. A connection whose request fails with a
+    network error (see watch) is discarded. Discarded connections, those
+    that sat idle for more than `max_idle` seconds and those that belong to
+    finished threads are closed, and replaced the next time they are asked
+    for
+    """
+
+    def __init__(self, max_idle=MAX_IDLE):
+        self.max_idle = max_idle
+        # (key, thread id) -> [connection, thread, last used]
+        self._conns = {}
+        self._next_eviction = 0
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        if now < self._next_eviction:
+            return
+        self._next_eviction = now + self.max_idle / 10.0
+        for k, entry in self._conns.items():
+            if not entry[1].is_alive() or now - entry[2] > self.max_idle:
+                del self._conns[k]
+                close_connection(entry[0])
+
+    def get(self, key, factory):
+        """
+        Returns the calling thread's connection for the given key, creating
+        it with factory() if there isn't a usable one
+        """
+
+        now = time.time()
+        thread = threading.current_thread()
+        with self._lock:
+            self._evict(now)
+            entry = self._conns.get((key, thread.ident))
+            # Thread ids get reused once threads are gone
+            if entry is None or entry[1] is not thread \
+                    or now - entry[2] > self.max_idle:
+                if entry is not None:
+                    close_connection(entry[0])
+                entry = [self.watch(factory()), thread, now]
+                self._conns[(key, thread.ident)] = entry
+            entry[2] = now
+            return entry[0]
+
+    def discard(self, conn):
+        """
+        Drops the given connection (i.e. after it failed) so a fresh
+        one is created next time
+        """
+
+        with self._lock:
+            for k, entry in self._conns.items():
+                if entry[0] is conn:
+                    del self._conns[k]
+        close_connection(conn)
+
+    def watch(self, conn):
+        """
+        Makes the connection discard itself when a request fails at the
+        connection level (once boto gave up retrying it), so the next
+        caller gets a fresh one instead of a broken socket
+        """
+
+        make_request = conn.make_request
+
+        def checked_request(*args, **kwargs):
+            try:
+                return make_request(*args, **kwargs)
+            except CONNECTION_ERRORS:
+                self.discard(conn)
+                raise
+
+        conn.make_request = checked_request
+        return conn
+
+
 class EC2ConnectionManager(ResourceManager):
 
     _driver_name = 'ec2connmanager'
     _attr_name = 'awsconnection'
 
-    _conns = {}
+    # Connections shared by all managers, per manager, region and thread
+    _pool = ConnectionPool()
+    # (credentials, region) -> (loaded at, {group id: (group name, vpc id)})
+    _sg_index = {}
+    _sg_locks = {}
+    _sg_locks_lock = threading.Lock()
+    # "access key/region/image id" -> image metadata, shared by all managers
+    _images = {}
+    _image_files = set()
+    _images_lock = threading.Lock()
+    _describe_calls = {
+        'instance': ('get_all_instances', 'instance-id'),
+        'vpc': ('get_all_vpcs', 'vpc-id'),
+        'subnet': ('get_all_subnets', 'subnet-id'),
+    }
     _properties = {
         'aws_access_key_id': None,
         'aws_secret_access_key': None,
+        # If set, image metadata is persisted in this file across runs
+        'image_cache_file': None,
     }
 
+    def _connect(self, region):
+        return ec2.connect_to_region(
+            region,
+            aws_access_key_id=self.aws_access_key_id,
+            aws_secret_access_key=self.aws_secret_access_key
+        )
+
     def _connection(self, region=None):
         """
-        Returns a connection "pool" (just a dict with an object per region
-        used) to the calling code
+        Returns the calling thread's connection to the given region
+        for this manager. Its requests are rate limited per credentials,
+        region and class of action, and retried when throttled. Pooled
+        connections are keyed by the manager's name, the credentials are
+        only read (from the database) when a connection is created
         """
         r = region or 'us-east-1'
-        if r not in self._conns:
-            self._conns[r] = ec2.connect_to_region(
-                r,
-                aws_access_key_id=self.aws_access_key_id,
-                aws_secret_access_key=self.aws_secret_access_key
-            )
-        return self._conns[r]
+        return self._pool.get(
+            (self._driver_name, self.name, r),
+            lambda: limiter.wrap(self._connect(r), r, self.aws_access_key_id)
+        )
 
     def _instance_to_dict(self, instance):
         """
@@ -64,6 +210,28 @@ class EC2ConnectionManager(ResourceManager):
             data['vpc_id'] = securitygroup.vpc_id
         return data
 
+    def _image_to_dict(self, image):
+        """
+        Returns a dictionary with the Image information needed to launch it
+        """
+
+        mapping = {}
+        for dev, bdt in (image.block_device_mapping or {}).items():
+            mapping[dev] = {
+                'ephemeral_name': bdt.ephemeral_name,
+                'snapshot_id': bdt.snapshot_id,
+                'size': bdt.size,
+                'volume_type': bdt.volume_type,
+                'delete_on_termination': bdt.delete_on_termination,
+            }
+        return {
+            'image_id': image.id,
+            'region': image.region.name,
+            'root_device_type': image.root_device_type,
+            'root_device_name': image.root_device_name,
+            'block_device_mapping': mapping,
+        }
+
     def _connection_to_dict(self, connection):
         """
         Returns a dictionary with Instance information
@@ -73,27 +241,314 @@ class EC2ConnectionManager(ResourceManager):
             'region': connection.region.name,
         }
 
-    def get_all_instance_resources(self, regions=[]):
+    def _map_regions(self, func, regions, workers=None):
         """
-        Query AWS and return all active ec2 instances and their state. If
-        a list of region names is provided, only return the instances
-        running in those regions
+        Calls func(region) for every given region on a bounded pool of
+        threads and returns a list of (region, result, error) tuples in the
+        same order as the regions. An exception raised while querying one
+        region is returned as its error instead of aborting the others
         """
 
-        instance_resources = []
+        def call(region):
+            try:
+                return (region, func(region), None)
+            except Exception as e:
+                logging.warning('Querying region %s failed: %s' % (region, e,))
+                return (region, None, e)
 
-        rl = regions or [r.name for r in self._connection().get_all_regions()]
+        workers = min(workers or DEFAULT_WORKERS, len(regions))
+        if workers <= 1:
+            return [call(_) for _ in regions]
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(call, regions)
+        finally:
+            pool.close()
+            pool.join()
 
-        for region in rl:
+    def _iter_region_pages(self, region, page_size=PAGE_SIZE):
+        """
+        Yields the instance records of a region, one list per
+        DescribeInstances page, following the NextToken until exhausted
+        """
 
-            for reservation in self._connection(region).get_all_instances():
+        conn = self._connection(region)
+        next_token = None
+        while True:
+            rs = conn.get_all_reservations(
+                max_results=page_size,
+                next_token=next_token
+            )
+            page = []
+            for reservation in rs:
                 for instance in reservation.instances:
-                    instance_resources.append({
+                    page.append({
                         'resource': self._instance_to_dict(instance),
                         'state': instance.state
                     })
+            yield page
+            next_token = rs.next_token
+            if not next_token:
+                break
+
+    def iter_instance_resources(self, regions=[], workers=None, page_size=PAGE_SIZE):
+        """
+        Generator version of get_all_instance_resources, yields instance
+        records page by page as the regions answer. Up to `workers` regions
+        are scanned in parallel and scanning threads wait for the caller to
+        consume their pages, so only a handful of pages are held in memory.
+        A region that fails to answer yields a single record with an
+        'error' key and the rest of the scan goes on
+        """
+
+        rl = regions or [r.name for r in self._connection().get_all_regions()]
+        workers = min(workers or DEFAULT_WORKERS, len(rl))
+
+        def error_page(region, error):
+            logging.warning('Querying region %s failed: %s' % (region, error,))
+            return [{
+                'resource': {'region': region},
+                'state': None,
+                'error': str(error),
+            }]
+
+        if workers <= 1:
+            for region in rl:
+                try:
+                    for page in self._iter_region_pages(region, page_size):
+                        for record in page:
+                            yield record
+                except Exception as e:
+                    for record in error_page(region, e):
+                        yield record
+            return
+
+        pages = Queue.Queue(maxsize=2 * workers)
+        stop = threading.Event()
+
+        def put(page):
+            while not stop.is_set():
+                try:
+                    pages.put(page, timeout=1)
+                    return True
+                except Queue.Full:
+                    continue
+            return False
+
+        def scan(region):
+            try:
+                for page in self._iter_region_pages(region, page_size):
+                    if not put(page):
+                        return
+            except Exception as e:
+                put(error_page(region, e))
+            finally:
+                # None flags this region as done
+                put(None)
+
+        pool = ThreadPool(workers)
+        try:
+            for region in rl:
+                pool.apply_async(scan, (region,))
+            pending = len(rl)
+            while pending:
+                page = pages.get()
+                if page is None:
+                    pending -= 1
+                    continue
+                for record in page:
+                    yield record
+        finally:
+            stop.set()
+            pool.close()
+            pool.join()
+
+    def get_all_instance_resources(self, regions=[], workers=None):
+        """
+        Query AWS and return all active ec2 instances and their state. If
+        a list of region names is provided, only return the instances
+        running in those regions. See iter_instance_resources() for the
+        parallelism and error handling
+        """
+
+        return list(self.iter_instance_resources(regions, workers))
+
+    def describe(self, kind, ids, region=None):
+        """
+        Query AWS for the given ids of a kind of object ('instance', 'vpc'
+        or 'subnet') using as few describe calls as possible and return a
+        dictionary of boto objects keyed by id. Ids unknown to AWS are
+        left out
+        """
+
+        call, id_filter = self._describe_calls[kind]
+        objects = {}
+        ids = list(ids)
+        conn = self._connection(region)
+        for i in range(0, len(ids), DESCRIBE_CHUNK_SIZE):
+            rs = getattr(conn, call)(
+                filters={id_filter: ids[i:i + DESCRIBE_CHUNK_SIZE]}
+            )
+            for obj in rs:
+                # instances come wrapped in reservations
+                for o in getattr(obj, 'instances', [obj]):
+                    objects[o.id] = o
+        return objects
+
+    def get_volumes(self, region=None, filters=None, page_size=VOLUME_PAGE_SIZE):
+        """
+        Returns all the volumes in the region matching the given filters,
+        following the DescribeVolumes NextToken (boto's get_all_volumes
+        only returns the first page)
+        """
+
+        conn = self._connection(region)
+        params = {'MaxResults': page_size}
+        if filters:
+            conn.build_filter_params(params, filters)
+        volumes = []
+        while True:
+            rs = conn.get_list(
+                'DescribeVolumes', params,
+                [('item', ec2.volume.Volume)], verb='POST'
+            )
+            volumes.extend(rs)
+            if not rs.next_token:
+                break
+            params['NextToken'] = rs.next_token
+        return volumes
+
+    def _security_group_lock(self, region):
+        with self._sg_locks_lock:
+            return self._sg_locks.setdefault(
+                (self.aws_access_key_id, region), threading.Lock()
+            )
+
+    def _load_security_groups(self, region, refresh=False):
+        """
+        Returns the security group index for these credentials and region,
+        describing the groups if it's missing, older than SG_INDEX_TTL or
+        a refresh is asked for. Callers must hold the region's lock
+        """
+
+        key = (self.aws_access_key_id, region)
+        now = time.time()
+        loaded, index = self._sg_index.get(key, (0, None))
+        if refresh or index is None or now - loaded > SG_INDEX_TTL:
+            index = dict([
+                (_.id, (_.name, _.vpc_id))
+                for _ in self._connection(region).get_all_security_groups()
+            ])
+            self._sg_index[key] = (now, index)
+        return index
+
+    def get_security_groups(self, region=None, vpc_id=None):
+        """
+        Returns a {group id: group name} dictionary of the security groups
+        in the region, only those in the VPC if vpc_id is given. Groups are
+        described from AWS at most once every SG_INDEX_TTL seconds per
+        credentials and region
+        """
+
+        r = region or 'us-east-1'
+        with self._security_group_lock(r):
+            return dict([
+                (k, v[0]) for k, v in self._load_security_groups(r).items()
+                if not vpc_id or v[1] == vpc_id
+            ])
+
+    def get_or_create_security_group(self, name, region=None, vpc_id=None):
+        """
+        Returns the id of the named security group (in the VPC if vpc_id is
+        given), creating it if it doesn't exist. Lookup and creation happen
+        under the region's lock so concurrent creates won't duplicate it.
+        The groups are described again before creating one, in case it was
+        created elsewhere since the index was loaded
+        """
 
-        return instance_resources
+        r = region or 'us-east-1'
+        with self._security_group_lock(r):
+            for refresh in (False, True):
+                groups = self._load_security_groups(r, refresh)
+                for k, v in groups.items():
+                    if v[0] == name and (not vpc_id or v[1] == vpc_id):
+                        return k
+            group = self._connection(r).create_security_group(
+                name=name,
+                description='Created on %s' % (datetime.now(),),
+                vpc_id=vpc_id
+            )
+            groups[group.id] = (group.name, vpc_id)
+            return group.id
+
+    def _load_images(self):
+        """
+        Merges the persisted image metadata (if any) into the cache, only
+        once per file. Callers must hold the images lock
+        """
+
+        filename = self.image_cache_file
+        if not filename or filename in self._image_files:
+            return
+        self._image_files.add(filename)
+        if os.path.isfile(filename):
+            f = open(filename, 'rb')
+            self._images.update(json.load(f))
+            f.close()
+
+    def _save_images(self):
+        """
+        Persists the image metadata if there is a file to do so. Callers
+        must hold the images lock
+        """
+
+        filename = self.image_cache_file
+        if not filename:
+            return
+        tmp = '%s.tmp' % (filename,)
+        f = open(tmp, 'wb')
+        json.dump(self._images, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(tmp, filename)
+
+    def _image_key(self, image_id, region=None):
+        # Another account may not be allowed to launch the same image
+        return '%s/%s/%s' % (
+            self.aws_access_key_id, region or 'us-east-1', image_id,
+        )
+
+    def get_image_info(self, image_id, region=None):
+        """
+        Returns the metadata (see _image_to_dict) of the given AMI. Images
+        are only described once per credentials, and kept in
+        image_cache_file if set
+        """
+
+        key = self._image_key(image_id, region)
+        with self._images_lock:
+            self._load_images()
+            info = self._images.get(key)
+        if info is None:
+            image = self._connection(region).get_image(image_id)
+            if not image:
+                raise EC2ConnManagerException(
+                    'Image %s does not exist in %s' % (image_id, region,)
+                )
+            info = self._image_to_dict(image)
+            with self._images_lock:
+                self._images[key] = info
+                self._save_images()
+        return info
+
+    def forget_image(self, image_id, region=None):
+        """
+        Drops the metadata of an AMI, i.e. when it's been deregistered
+        """
+
+        with self._images_lock:
+            self._load_images()
+            if self._images.pop(self._image_key(image_id, region), None):
+                self._save_images()
 
     def additional_attrs(self, thing, resource, number=True):
         """
@@ -110,13 +565,21 @@ class EC2ConnectionManager(ResourceManager):
 
             logging.debug(data)
             if data:
-                thing.add_attr(
-                    key=self._attr_name,
-                    subkey=name,
-                    number=number,
-                    value=data
-                )
-                return data
+                return self.add_resource_attrs(thing, name, data, number)
+
+    def add_resource_attrs(self, thing, name, data, number=True):
+        """
+        Record an already serialized resource (as returned by the
+        *_to_dict methods) as additional resource attrs
+        """
+
+        thing.add_attr(
+            key=self._attr_name,
+            subkey=name,
+            number=number,
+            value=data
+        )
+        return data
 
     def allocator(self, thing, resource=(), number=True):
         """
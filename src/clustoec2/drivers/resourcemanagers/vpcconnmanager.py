@@ -19,21 +19,13 @@ class VPCConnManagerException(ResourceException):
 class VPCConnectionManager(ec2connmanager.EC2ConnectionManager):
 
     _driver_name = 'vpcconnmanager'
-    _conns = {}
 
-    def _connection(self, region=None):
-        """
-        Returns a connection "pool" (just a dict with an object per region
-        used) to the calling code
-        """
-        r = region or 'us-east-1'
-        if r not in self._conns:
-            self._conns[r] = vpc.connect_to_region(
-                r,
-                aws_access_key_id=self.aws_access_key_id,
-                aws_secret_access_key=self.aws_secret_access_key,
-            )
-        return self._conns[r]
+    def _connect(self, region):
+        return vpc.connect_to_region(
+            region,
+            aws_access_key_id=self.aws_access_key_id,
+            aws_secret_access_key=self.aws_secret_access_key,
+        )
 
     def _instance_to_dict(self, instance):
         """
@@ -85,10 +77,4 @@ class VPCConnectionManager(ec2connmanager.EC2ConnectionManager):
 
             logging.debug(data)
             if data:
-                thing.add_attr(
-                    key=self._attr_name,
-                    subkey=name,
-                    number=number,
-                    value=data
-                )
-                return data
+                return self.add_resource_attrs(thing, name, data, number)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+import json
+import logging
+import os
+import threading
+
+# Catalog shipped with the package, can be overridden with the environment
+CATALOG_FILE = os.environ.get(
+    'CLUSTOEC2_INSTANCE_TYPES',
+    os.path.join(os.path.dirname(__file__), 'instance_types.json')
+)
+FIELDS = ('ephemeral', 'vcpus', 'memory', 'network')
+
+
+class InstanceTypeCatalog(object):
+    """
+    Instance type name -> ephemeral drive count, vCPUs, memory (in MiB)
+    and network performance. The catalog file is only read the first time
+    it is needed, and can be refreshed from a DescribeInstanceTypes dump
+    """
+
+    def __init__(self, filename=CATALOG_FILE):
+        self.filename = filename
+        self._types = None
+        self._unknown = set()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._types is None:
+            with self._lock:
+                if self._types is None:
+                    with open(self.filename) as f:
+                        data = json.load(f)
+                    fields = data.get('fields', FIELDS)
+                    self._types = dict([
+                        (k, dict(zip(fields, v)))
+                        for k, v in data['types'].items()
+                    ])
+        return self._types
+
+    def __contains__(self, instance_type):
+        return instance_type in self._load()
+
+    def get(self, instance_type, default=None):
+        """
+        Returns a dictionary with the instance type's specs
+        """
+
+        return self._load().get(instance_type, default)
+
+    def ephemeral_drives(self, instance_type):
+        """
+        Returns how many ephemeral drives the instance type comes with.
+        Unknown types get none, with a warning (once per type) since their
+        instance store drives won't be mapped
+        """
+
+        specs = self.get(instance_type)
+        if specs is None:
+            with self._lock:
+                warn = instance_type not in self._unknown
+                self._unknown.add(instance_type)
+            if warn:
+                logging.warning(
+                    'Instance type %s is not in %s, no ephemeral drives will '
+                    'be mapped. Refresh the catalog (see refresh())' % (
+                        instance_type, self.filename,
+                    )
+                )
+            return 0
+        return specs.get('ephemeral', 0)
+
+    def find(self, vcpus=0, memory=0, ephemeral=0):
+        """
+        Returns the names of the instance types with at least the given
+        vCPUs, memory (in MiB) and ephemeral drives, smallest first
+        """
+
+        matches = [
+            (v['vcpus'], v['memory'], k) for k, v in self._load().items()
+            if v['vcpus'] >= vcpus and v['memory'] >= memory
+            and v['ephemeral'] >= ephemeral
+        ]
+        return [_[2] for _ in sorted(matches)]
+
+    def refresh(self, dump, filename=None):
+        """
+        Replaces the catalog with the instance types from a DescribeInstanceTypes
+        dump, as written by `aws ec2 describe-instance-types`. The dump can be
+        a filename, a response or a list of paginated responses. If a filename
+        is given, the new catalog is saved there
+        """
+
+        if isinstance(dump, basestring):
+            with open(dump) as f:
+                dump = json.load(f)
+        if isinstance(dump, dict):
+            dump = [dump]
+        types = {}
+        for page in dump:
+            for it in page.get('InstanceTypes', []):
+                disks = (it.get('InstanceStorageInfo') or {}).get('Disks', [])
+                types[it['InstanceType']] = {
+                    'ephemeral': sum([_.get('Count', 0) for _ in disks]),
+                    'vcpus': it.get('VCpuInfo', {}).get('DefaultVCpus', 0),
+                    'memory': it.get('MemoryInfo', {}).get('SizeInMiB', 0),
+                    'network': it.get('NetworkInfo', {}).get('NetworkPerformance'),
+                }
+        with self._lock:
+            self._types = types
+            self._unknown = set()
+        if filename:
+            self.save(filename)
+        return len(types)
+
+    def save(self, filename):
+        """
+        Writes the catalog in the same compact format it is shipped in
+        """
+
+        data = {
+            'fields': FIELDS,
+            'types': dict([
+                (k, [v[_] for _ in FIELDS]) for k, v in self._load().items()
+            ]),
+        }
+        tmp = '%s.tmp' % (filename,)
+        with open(tmp, 'w') as f:
+            json.dump(data, f, sort_keys=True)
+        os.rename(tmp, filename)
+
+
+catalog = InstanceTypeCatalog()
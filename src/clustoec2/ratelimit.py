@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+import boto
+from clustoec2.stats import recorder
+import random
+import threading
+import time
+
+# (bucket size, refills per second) for each class of EC2 actions, the
+# same scheme (and roughly the defaults) AWS uses to throttle accounts
+RATE_LIMITS = {
+    'describe': (100, 20.0),
+    'instances': (50, 5.0),
+    'mutate': (50, 5.0),
+}
+INSTANCE_ACTIONS = (
+    'RunInstances',
+    'StartInstances',
+    'StopInstances',
+    'RebootInstances',
+    'TerminateInstances',
+)
+THROTTLE_ERRORS = ('RequestLimitExceeded', 'Throttling')
+# The refill rate grows by this fraction of the maximum on every success
+# and is halved on every throttle, but never below MIN_RATE of the maximum
+RATE_INCREASE = 0.01
+MIN_RATE = 1 / 32.0
+# Throttled calls are retried after a random wait of up to
+# BACKOFF * 2 ** attempt seconds, capped at MAX_BACKOFF
+BACKOFF = 0.5
+MAX_BACKOFF = 20
+
+
+def action_class(action):
+    if action.startswith('Describe') or action.startswith('Get'):
+        return 'describe'
+    if action in INSTANCE_ACTIONS:
+        return 'instances'
+    return 'mutate'
+
+
+class TokenBucket(object):
+    """
+    Token bucket whose refill rate adapts to throttling: it is increased
+    additively as calls go through and decreased multiplicatively (AIMD)
+    every time AWS throttles one
+    """
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.counters = {'calls': 0, 'throttles': 0, 'retries': 0}
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token and returns how many seconds the caller has
+        to wait before using it
+        """
+
+        with self._lock:
+            now = time.time()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self._stamp) * self.rate
+            )
+            self._stamp = now
+            self.tokens -= 1
+            self.counters['calls'] += 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(
+                self.max_rate, self.rate + self.max_rate * RATE_INCREASE
+            )
+
+    def retried(self):
+        with self._lock:
+            self.counters['retries'] += 1
+
+    def throttled(self, attempt):
+        """
+        Slows the bucket down and returns how long to back off
+        """
+
+        with self._lock:
+            self.counters['throttles'] += 1
+            self.rate = max(self.max_rate * MIN_RATE, self.rate / 2)
+            # Whatever burst was left is what got us throttled
+            self.tokens = min(self.tokens, 0)
+        return min(MAX_BACKOFF, random.uniform(0, BACKOFF * 2 ** attempt))
+
+
+class RateLimiter(object):
+    """
+    Keeps a TokenBucket per credentials, region and class of action, and
+    wraps boto connections so every request they make goes through them
+    """
+
+    def __init__(self, limits=RATE_LIMITS):
+        self.limits = limits
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, scope, region, action):
+        key = (scope, region, action_class(action))
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(*self.limits[key[2]])
+            return self._buckets[key]
+
+    def stats(self):
+        """
+        Returns the current rate and the counters of every bucket
+        """
+
+        with self._lock:
+            items = self._buckets.items()
+        return [
+            dict(
+                region=region, action_class=klass, rate=bucket.rate,
+                **bucket.counters
+            ) for (scope, region, klass), bucket in sorted(items)
+        ]
+
+    def wrap(self, conn, region, scope=None):
+        """
+        Makes all the requests of the given boto connection wait for their
+        bucket, and retries the throttled ones with a backoff (as many
+        times as boto retries failed requests). Every request is also
+        timed and counted in the stats recorder
+        """
+
+        num_retries = boto.config.getint('Boto', 'num_retries', conn.num_retries)
+
+        def make_request(action, params=None, path='/', verb='GET'):
+            bucket = self.bucket(scope, region, action or '')
+
+            retries = []
+
+            def retry_handler(response, i, next_sleep):
+                if response.status < 400:
+                    bucket.succeeded()
+                    return None
+                body = response.read()
+                if not [_ for _ in THROTTLE_ERRORS if _ in body]:
+                    return None
+                delay = bucket.throttled(i)
+                # Leave the last attempt to boto so it raises the error
+                if i >= num_retries:
+                    return None
+                bucket.retried()
+                retries.append(i)
+                return (
+                    '%s throttled in %s, retrying' % (action, region),
+                    i + 1, max(delay, bucket.reserve())
+                )
+
+            started = time.time()
+            bucket.acquire()
+            # Same as AWSQueryConnection.make_request, plus the handler
+            http_request = conn.build_base_http_request(
+                verb, path, None, params, {}, '', conn.host
+            )
+            if action:
+                http_request.params['Action'] = action
+            if conn.APIVersion:
+                http_request.params['Version'] = conn.APIVersion
+            response = None
+            try:
+                response = conn._mexe(http_request, retry_handler=retry_handler)
+                return response
+            finally:
+                recorder.record_call(
+                    action, region, time.time() - started,
+                    retries=len(retries),
+                    bytes_out=len(http_request.body or ''),
+                    # boto caches the body, the caller can still read it
+                    bytes_in=response is not None and len(response.read()) or 0,
+                    error=response is None or response.status >= 400,
+                )
+
+        conn.make_request = make_request
+        return conn
+
+
+limiter = RateLimiter()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+import json
+import re
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import sys
+import threading
+import time
+
+# Upper bounds (in seconds) of the latency histogram buckets, anything
+# slower falls in an extra last bucket
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_statement_re = re.compile(r'^\s*(\w+).*?\b(?:FROM|INTO|UPDATE)\s+(\w+)', re.I | re.S)
+
+
+class CallStats(object):
+    """
+    Count, latency histogram, retries, errors and bytes of one kind of call
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, seconds, retries=0, bytes_out=0, bytes_in=0, error=False):
+        self.count += 1
+        self.errors += error and 1 or 0
+        self.retries += retries
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.bytes_out += bytes_out
+        self.bytes_in += bytes_in
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(LATENCY_BUCKETS)
+        self.histogram[i] += 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'retries': self.retries,
+            'total': self.total,
+            'max': self.max,
+            'mean': self.count and self.total / self.count or 0.0,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'histogram': dict(
+                zip([str(_) for _ in LATENCY_BUCKETS] + ['inf'], self.histogram)
+            ),
+        }
+
+
+class Recorder(object):
+    """
+    Collects CallStats for AWS requests, by action and region, and for
+    clusto database statements, by statement type and table
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._db = {}
+        self._lock = threading.Lock()
+        self._watching = False
+
+    def _add(self, table, key, *args, **kwargs):
+        with self._lock:
+            if key not in table:
+                table[key] = CallStats()
+            table[key].add(*args, **kwargs)
+
+    def record_call(self, action, region, seconds, **kwargs):
+        self._add(self._calls, (action, region), seconds, **kwargs)
+
+    def record_db(self, operation, seconds, **kwargs):
+        self._add(self._db, operation, seconds, **kwargs)
+
+    def watch_db(self):
+        """
+        Starts timing every statement clusto sends to the database
+        """
+
+        if self._watching:
+            return
+        self._watching = True
+
+        def before(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('clustoec2_started', []).append(time.time())
+
+        def after(conn, cursor, statement, parameters, context, executemany):
+            seconds = time.time() - conn.info['clustoec2_started'].pop()
+            match = _statement_re.match(statement)
+            if match:
+                operation = '%s %s' % (match.group(1).upper(), match.group(2))
+            else:
+                operation = statement.split(None, 1)[0].upper()
+            self.record_db(operation, seconds)
+
+        event.listen(Engine, 'before_cursor_execute', before)
+        event.listen(Engine, 'after_cursor_execute', after)
+
+    def as_dict(self):
+        # ratelimit records its calls here, so it can only be imported late
+        from clustoec2.ratelimit import limiter
+
+        with self._lock:
+            calls = self._calls.items()
+            db = self._db.items()
+        return {
+            'throttling': limiter.stats(),
+            'aws': [
+                dict(action=action, region=region, **stats.as_dict())
+                for (action, region), stats in sorted(calls)
+            ],
+            'db': [
+                dict(operation=operation, **stats.as_dict())
+                for operation, stats in sorted(db)
+            ],
+        }
+
+    def summary(self):
+        """
+        Returns a plain text table of the calls, slowest (in total) first,
+        followed by the rate limiter's throttle and retry counters
+        """
+
+        data = self.as_dict()
+        lines = []
+        for title, rows, name in (
+            ('AWS requests', data['aws'], lambda _: '%s %s' % (_['action'], _['region'])),
+            ('Database statements', data['db'], lambda _: _['operation']),
+        ):
+            lines.append(
+                '%-48s %7s %7s %7s %9s %9s %9s %11s' % (
+                    title, 'count', 'errors', 'retries', 'total(s)',
+                    'mean(ms)', 'max(ms)', 'bytes in',
+                )
+            )
+            for row in sorted(rows, key=lambda _: -_['total']):
+                lines.append(
+                    '%-48s %7d %7d %7d %9.2f %9.1f %9.1f %11d' % (
+                        name(row)[:48], row['count'], row['errors'],
+                        row['retries'], row['total'], row['mean'] * 1000,
+                        row['max'] * 1000, row['bytes_in'],
+                    )
+                )
+            lines.append('')
+        lines.append(
+            '%-48s %7s %9s %7s %9s' % (
+                'Rate limits', 'calls', 'throttles', 'retries', 'rate(/s)',
+            )
+        )
+        for row in data['throttling']:
+            lines.append(
+                '%-48s %7d %9d %7d %9.2f' % (
+                    ('%s %s' % (row['action_class'], row['region']))[:48],
+                    row['calls'], row['throttles'], row['retries'], row['rate'],
+                )
+            )
+        lines.append('')
+        return '\n'.join(lines)
+
+    def report(self, format='summary', stream=None):
+        """
+        Writes the collected stats (to stderr by default, so they don't mix
+        with the command output) as a summary table or as JSON
+        """
+
+        stream = stream or sys.stderr
+        if format == 'json':
+            stream.write(json.dumps(self.as_dict(), indent=2, sort_keys=True))
+            stream.write('\n')
+        else:
+            stream.write(self.summary())
+
+
+recorder = Recorder()
+
+
+def run_script(script, args):
+    """
+    Runs a command script and, if its --stats argument was given, reports
+    the AWS and database stats collected while it ran
+    """
+
+    if not getattr(args, 'stats', None):
+        return script.run(args)
+    recorder.watch_db()
+    try:
+        return script.run(args)
+    finally:
+        recorder.report(args.stats)